@@ -0,0 +1,169 @@
+#
+# Benchmarks of the library
+# Time and peak memory of the main operations for models of growing size.
+#
+# Usage (from the root of the repository) :
+#     python benchmarks/bench.py --quick --output results.json
+#     python benchmarks/bench.py --output new.json --baseline results.json
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "library")) # Path of the library
+
+from TD import EmphaticTD, OffTD
+from models import Model, Grid
+from policies import LeftRightPolicy, GridRandomWalkPolicy
+
+
+
+#
+# Scenarios : each one builds a model from (n, p)
+#
+
+def chain(n, p, seed = 0):
+    '''
+        Left-right chain of n states with p random features (the five states example scaled up)
+    '''
+    rng = np.random.default_rng(seed)
+    features = rng.random((n, p)) if p < n else np.identity(n)
+    discounts = np.ones(n)
+    discounts[[0, -1]] = 0
+    return Model(
+                features = features,
+                R = np.ones((n, n)),
+                pi = LeftRightPolicy(p_right = 1),
+                mu = LeftRightPolicy(p_left = 2/3),
+                v_pi = np.arange(n, 0, -1),
+                I = np.ones(n),
+                discounts = discounts,
+                S0 = 0,
+                theta0 = np.zeros(features.shape[1]),
+            )
+
+def grid(n, p, seed = 0):
+    '''
+        Square grid of about n states with tabular features (p is ignored), as in the 2D grid example
+    '''
+    l = max(2, int(round(np.sqrt(n))))
+    R = np.full((l, l), -0.5)
+    R[-1, -1] = 5
+    D = np.ones((l, l))
+    D[-1, -1] = 0
+    return Grid(
+                l_x = l,
+                l_y = l,
+                R = R,
+                pi = GridRandomWalkPolicy(p_down = 0.5, p_right = 0.5),
+                mu = GridRandomWalkPolicy(0.25, 0.25, 0.25, 0.25),
+                v_pi = np.zeros(l*l),
+                I = np.ones(l*l),
+                discounts = D,
+                S0 = (0, 0),
+                theta0 = np.ones(l*l),
+            )
+
+SCENARIOS = {"chain" : chain, "grid" : grid}
+
+# Sizes swept : (n, p, N, T)
+QUICK = {"n" : [10, 50], "p" : [5], "N" : [100], "T" : [500]}
+FULL = {"n" : [10, 100, 1000], "p" : [10, 100], "N" : [100, 1000], "T" : [1000]}
+
+
+
+#
+# Measures
+#
+
+def measure(f, repeat = 1):
+    '''
+        Return the best time (s) of repeat calls of f and the peak memory (MB) of the first call
+    '''
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+
+    best = np.inf
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t)
+    return best, peak
+
+def operations(model, N, T):
+    '''
+        The operations timed for one model (name -> function)
+    '''
+    off = OffTD(alpha = 0.01, lambdas = 0)
+    emp = EmphaticTD(alpha = 0.001, lambdas = 0)
+    thetas = emp.run(model, T, N, verbose = False, rng = 0)
+    return {
+        "stationary" : lambda : model.mu._load_stationary(),
+        "offtd_run" : lambda : off.run(model, T, N, verbose = False, rng = 0),
+        "emphatic_run" : lambda : emp.run(model, T, N, verbose = False, rng = 0),
+        "optimal_run" : lambda : EmphaticTD(alpha = 0.001, lambdas = 0).optimal_run(model, T), # New instance : no cache
+        "parallel_msve" : lambda : model.parallel_msve(thetas),
+    }
+
+def run(sizes, scenarios, repeat = 1, verbose = True):
+    '''
+        Run all the benchmarks and return the list of results
+    '''
+    results = []
+    for name in scenarios:
+        for n, p, N, T in itertools.product(sizes["n"], sizes["p"], sizes["N"], sizes["T"]):
+            if p > n:
+                continue
+            model = SCENARIOS[name](n, p)
+            for op, f in operations(model, N, T).items():
+                seconds, peak = measure(f, repeat = repeat)
+                res = {"scenario" : name, "n" : model.n, "p" : model.p, "N" : N, "T" : T, "op" : op,
+                       "seconds" : seconds, "peak_mb" : peak}
+                results.append(res)
+                if verbose:
+                    print("{scenario:6} n={n:<6} p={p:<6} N={N:<6} T={T:<6} {op:14} {seconds:9.4f}s {peak_mb:9.1f}MB".format(**res))
+    return results
+
+def key(res):
+    return (res["scenario"], res["n"], res["p"], res["N"], res["T"], res["op"])
+
+def compare(results, baseline):
+    '''
+        Print the ratio new / baseline of the time and of the peak memory for the common benchmarks
+    '''
+    old = {key(r) : r for r in baseline}
+    print("\nComparison with the baseline (ratio new / old, < 1 is better)")
+    for r in results:
+        if key(r) in old:
+            b = old[key(r)]
+            print("{:6} n={:<6} p={:<6} N={:<6} T={:<6} {:14} time x{:6.2f}   memory x{:6.2f}".format(
+                *key(r), r["seconds"] / max(b["seconds"], 1e-12), r["peak_mb"] / max(b["peak_mb"], 1e-12)))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks of the TD library")
+    parser.add_argument("--quick", action = "store_true", help = "small sizes only")
+    parser.add_argument("--scenario", choices = list(SCENARIOS), action = "append", help = "default is all")
+    parser.add_argument("--repeat", type = int, default = 1, help = "the best time of repeat calls is kept")
+    parser.add_argument("--output", help = "write the results to this json file")
+    parser.add_argument("--baseline", help = "json file of previous results to compare with")
+    args = parser.parse_args()
+
+    results = run(QUICK if args.quick else FULL, args.scenario or list(SCENARIOS), repeat = args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"numpy" : np.__version__, "results" : results}, f, indent = 1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)["results"])
@@ -1,199 +1,697 @@
 import numpy as np
+import scipy.sparse as sp
+import warnings
 
-from utils import custom_mult
+from checkpoint import Checkpoint
+from utils import custom_mult, get_rng, get_precision, Recorder, identity, diag, gather
+from features import get_features
+from solvers import solve
+import expected
+import kernels
+from monitor import Monitor
+from metrics import OnlineMetrics
 
 class AbstractTD(object):
     '''
         Abstract class for all TD algorithm.
         It should be inherited by the algorithm class
+        backend is "numpy" or "numba" (compiled kernels of kernels.py, NumPy is used if numba
+        is not installed or if the model is sparse)
+        compact is the fraction of particles under which a step only updates the particles with a non zero
+        importance sampling ratio (the others do not learn from their transition), None to always update all of them
+        precision is the dtypes of the runs : "double" (default), "single" (float32 theta, traces and features)
+        or a Precision (see utils)
     '''
     
-    def __init__(self, alpha, lambdas):
+    def __init__(self, alpha, lambdas, backend = "numpy", compact = 0.4, precision = None):
         self.alpha = alpha
         self.lambdas = lambdas
+        self.compact = compact
+        self.precision = get_precision(precision)
+        if backend not in ("numpy", "numba"):
+            raise ValueError("Unknown backend {} (numpy or numba)".format(backend))
+        if backend == "numba" and not kernels.NUMBA:
+            warnings.warn("numba is not installed, the numpy backend is used")
+        self.backend = backend
 
 
+    # Number of weight vectors of size p in the state of the algorithm (theta and the secondary weights w for the gradient TD)
+    # The key matrices are the ones of this joint vector, theta is its first p values
+    vectors = 1
+
+    # Name printed in the progress
+    name = "TD"
+
+    def key_matrixes(self, model):
+        '''
+            Return the matrix A and b for the model (see _key_matrixes)
+            They are cached by the model for the parameters of the algorithm
+        '''
+        key = ("key_matrixes", type(self).__name__) + self._parameters(model)
+        return model.derived(key, lambda : self._key_matrixes(model))
+
+    def _key_matrixes(self, model):
+        '''
+            Compute the matrix A and b for the model (implemented by the algorithms)
+        '''
+        raise NotImplementedError("{} does not implement the key matrices".format(type(self).__name__))
+
     def optimal(self, model):
         '''
             Return the optimal theta for the model
+            A is factorized (LU) and the factorization is cached for the next calls
         '''
         A, b = self.key_matrixes(model)
-        return np.dot(np.linalg.inv(A), b)
-    
-    
-    
-    def optimal_run(self, model, T):
+        return solve(A, b)[:model.p]
+
+
+
+    def optimal_run(self, model, T, times = None):
         '''
             Return the optimal descent with the key matrix of the model
+            theta_t+1 = theta_t + alpha (b - A theta_t) is linear, so with z = (theta, 1) :
+                z_t = G^t z_0 with G = [[Id - alpha A, alpha b], [0, 1]]
+            G is diagonalized once (cached for the model, alpha and lambdas) and only
+            the steps in times are computed (default is all the steps from 0 to T).
+            If G is (almost) defective the powers of G are computed by squaring,
+            or the descent is iterated if it is cheaper (always for a sparse A).
+        '''
+        times = np.arange(T+1) if times is None else np.asarray(times, dtype = int)
+        p, q = model.p, self.vectors * model.p # theta is the first p values of the q weights
+        z0 = np.zeros(q+1)
+        z0[:p] = model.theta0
+        z0[-1] = 1
+        kind, descent = self._descent(model)
+
+        if kind == "eig":
+            vals, V, V_inv = descent
+            thetas = np.power.outer(vals, times).transpose() * V_inv.dot(z0) # (len(times), q+1)
+            return np.real(thetas.dot(V[:p].transpose()))
+
+        t_max = times.max() if len(times) else 0
+        if kind == "power" and len(times) * len(z0) * np.log2(t_max + 2) < t_max:
+            # Few steps needed : z_t from the previous step needed with G^(t - t_prev)
+            thetas = np.zeros((len(times), p))
+            order = np.argsort(times)
+            z, t_prev = z0, 0
+            for k in order:
+                z = np.linalg.matrix_power(descent, int(times[k]) - t_prev).dot(z)
+                t_prev = times[k]
+                thetas[k] = z[:p]
+            return thetas
+
+        # Iterate the descent up to the last step needed
+        A, b = self.key_matrixes(model) if kind == "loop" else (None, None)
+        z = z0
+        thetas = np.zeros((t_max+1, q))
+        thetas[0] = z0[:-1]
+        for t in range(0, t_max):
+            if kind == "loop":
+                thetas[t+1] = thetas[t] + self.alpha * (b - A.dot(thetas[t]))
+            else:
+                z = descent.dot(z)
+                thetas[t+1] = z[:-1]
+        return thetas[times, :p]
+
+    def expected_run(self, model, T, times = None):
+        '''
+            Return the expected-update trajectory of theta and the moments of the traces for the steps in times
+            (all the steps from 0 to T by default) : (thetas (len(times), p), info), see expected.expected_run.
+            Unlike optimal_run it starts from the distribution of S0 and gives the variance of F and of the updates
+            of each step, to screen the configurations without the particles.
+        '''
+        a, b, lambdas = self._emphasis(model)
+        return expected.expected_run(model, T, self.alpha, lambdas, a, b, times = times)
+
+    def _emphasis(self, model):
+        '''
+            Return (a, b, lambdas) for each state : the emphasis of the algorithm is M_t = a[S_t] + b[S_t] F_t
+            and its eligibility trace decays with gamma lambdas (see expected.py)
+        '''
+        raise NotImplementedError("{} has no expected update".format(type(self).__name__))
+
+    def _descent(self, model):
+        '''
+            Return how the deterministic descent is computed (see optimal_run), cached by the model for the parameters :
+                ("eig", (vals, V, V^-1)) the eigendecomposition of G
+                ("power", G) if G is (almost) defective
+                ("loop", None) if A is sparse
         '''
+        key = ("descent", type(self).__name__) + self._parameters(model)
+        return model.derived(key, lambda : self._load_descent(model))
+
+    def _load_descent(self, model):
         A, b = self.key_matrixes(model)
-        thetas = np.zeros((T+1, model.p))
-        thetas[0] = model.theta0
-        for t in range(0, T):
-            thetas[t+1] = thetas[t] + self.alpha * (b - np.dot(A, thetas[t]))
-        return thetas
-     
-    def _get_lambda(self, model):
+        if sp.issparse(A):
+            return ("loop", None)
+        q = len(b)
+        G = np.eye(q+1)
+        G[:q, :q] -= self.alpha * A
+        G[:q, q] = self.alpha * b
+        vals, V = np.linalg.eig(G)
+        if np.linalg.cond(V) > 1e8:
+            return ("power", G)
+        return ("eig", (vals, V, np.linalg.inv(V)))
+
+    def _parameters(self, model):
+        ''' The parameters the key matrices depend on (key of the derived quantities of the model) '''
+        return (self.alpha, tuple(self._get_lambda(model)))
+
+    def _compiled(self, model):
+        '''
+            True if the run uses the compiled kernels
+        '''
+        return self.backend == "numba" and kernels.available(model)
+
+    def _get_lambda(self, model, lambdas = None):
         '''
          Return a matrix of lambdas of good shape for the model (a lambda for each state)
+         lambdas is self.lambdas by default
         '''
+        lambdas = self.lambdas if lambdas is None else lambdas
         try:
             # Lambdas is a value for each state
-            len(self.lambdas) # if raise error this is not a list or an array
-            return np.array(self.lambdas)
+            len(lambdas) # if raise error this is not a list or an array
+            return np.array(lambdas)
         except:
             # Lambdas is a number
             n = model.n
-            return np.array([self.lambdas]*n)
-            
-     
-    
+            return np.array([lambdas]*n)
 
-class OffTD(AbstractTD):
-    
-    def run(self, model, T, N = 1, verbose = True):
+
+
+    def run(self, model, T, N = 1, verbose = True, rng = None, stride = 1, record = None, callback = None, keep = True, store = None, monitor = None, checkpoint = None, trajectories = None):
         '''
-         Compute the emphatic TD with T period for the model.
+         Compute the algorithm with T period for the model.
          It can do it for N particles in parallel.
+         rng is a seed or a numpy Generator to reproduce the run.
+         Only the current theta and traces are kept in memory, see Recorder for stride, record, callback, keep and store.
+         monitor is a Monitor (hooks every k steps, timers of the phases if profiling), it is kept in self.monitor.
+         verbose adds the progress hook.
+         model can be a ModelBatch : N particles are run in each of its models (B*N particles).
+         checkpoint is a Checkpoint (or a path) : the state of the run is saved every k steps and the run
+         is resumed from it if the file exists.
+         trajectories are the states of the particles sampled before (see Policy.trajectories) : several algorithms
+         given the same trajectories learn from the same transitions (common random numbers), rng is not used then.
+        '''
+        checkpoint = Checkpoint(checkpoint) if isinstance(checkpoint, str) else checkpoint
+        S, theta0 = model.start(N)
+        recorder = Recorder(model, T, stride = stride, record = record, callback = callback, keep = keep, store = store)
+        self.monitor = monitor = (Monitor() if monitor is None else monitor).start(T, len(S), name = self.name, verbose = verbose)
+
+        alphas = np.array([self.alpha], dtype = float)
+        lambdas = self._get_lambda(model)[None, :]
+        self._simulate(model, T, S, theta0, alphas, lambdas, get_rng(rng), recorder, monitor, single = True, checkpoint = checkpoint, trajectories = trajectories)
+
+        return recorder.result()
+
+    def sweep(self, model, T, N = 1, alphas = None, lambdas = None, verbose = True, rng = None, stride = 1, monitor = None, trajectories = None):
+        '''
+            Run the algorithm for every (alpha, lambda) of the grid alphas x lambdas in one pass.
+            The behavior policy mu does not depend on alpha and lambda so all the configurations
+            share the same sampled states S, theta is a (K, N, p) tensor updated in a single loop.
+            alphas (and lambdas) default to the one of the algorithm.
+            Return the msve of each particle every stride steps : shape (len(alphas), len(lambdas), steps, N)
+            monitor is a Monitor and trajectories the states sampled before as in run
+        '''
+        # Shortcut
+        m = model
+        alphas = np.atleast_1d(self.alpha if alphas is None else alphas).astype(float)
+        lambdas = [self.lambdas] if lambdas is None else list(lambdas)
+
+        # One row for each configuration (alpha major)
+        K = len(alphas) * len(lambdas)
+        config_alphas = np.repeat(alphas, len(lambdas))
+        config_lambdas = np.array([self._get_lambda(m, l) for l in lambdas] * len(alphas)) # (K, n)
+
+        quadratic = OnlineMetrics(m) # msve from the quadratic form (no (K*N, n) estimates)
+        def msve(theta):
+            return quadratic.msve(theta.reshape((K*N, m.p))).reshape((K, N))
+        recorder = Recorder(model, T, stride = stride, record = msve)
+        self.monitor = monitor = (Monitor() if monitor is None else monitor).start(T, N, name = "sweep of {} configurations".format(K), verbose = verbose)
+
+        S, theta0 = m.start(N)
+        self._simulate(m, T, S, theta0, config_alphas, config_lambdas, get_rng(rng), recorder, monitor, trajectories = trajectories)
+
+        res = recorder.result() # (steps, K, N)
+        return np.moveaxis(res, 0, 1).reshape((len(alphas), len(lambdas), res.shape[0], N))
+
+
+
+    #
+    # Stepping engine shared by the algorithms
+    # theta is a (K, N, p) tensor : K configurations (alpha, lambdas) of N particles sharing the same states S.
+    # An algorithm only gives its hooks (_init_traces, _update_traces, _update_theta and maybe _sample, _delta, _kernel).
+    #
+
+    def _simulate(self, model, T, S, theta0, alphas, lambdas, rng, recorder, monitor, single = False, checkpoint = None, trajectories = None):
+        '''
+            Run the T steps from the states S (N,) and theta0 (N, p) (see Model.start)
+            for the K configurations of alphas (K,) and lambdas (K, n).
+            The recorder is called with theta (K, N, p), or theta[0] (N, p) and S if single (run).
+            If the file of the checkpoint exists the run starts from it, the state is saved every checkpoint.every steps.
+            The next states are read in trajectories if given (see Policy.trajectories), else they are sampled by blocks.
         '''
         # Shortcut
         m = model
-        
-        
-        # Init memory
-        theta = np.zeros((T+1, N, m.p))
-        S = np.zeros((T+1, N), dtype = np.int)
-        
+        K, N = len(alphas), len(S)
+
         # Set t=0
-        S[0] = m.S0
-        theta[0] = m.theta0
-        
-        # Iterating over t (in parallel for the N particles)
-        for t in range(T):
-            if verbose and (t % 999 == 0):
-                print("Computing offTD... ({}/{})".format(t+1, T), end = "\r")
-            S[t+1] = m.mu.parallel_steps(S[t]) # Pick next step
-                
-            # Iterate theta (equation 1)
-            # delta is the parathesis of equation 1
-            delta = m.R[S[t], S[t+1]]\
-                    + m.discounts[S[t+1]] * np.sum(theta[t] * m.features[S[t+1]], axis = 1)\
-                    - np.sum(theta[t] * m.features[S[t]], axis = 1)
-            theta[t+1] = theta[t] + custom_mult(m.features[S[t]], self.alpha * m.phi[S[t], S[t+1]] * delta)
-        
-        if verbose:
-            print("offTD has been computed for {} steps and {} particles.".format(T, N))    
-        
-        return theta
-    
-    
-    def key_matrixes(self, model):
+        features = self._features(m)
+        S = S.astype(self.precision.states_dtype(m.n))
+        X = features.take(S) # Features of the current states (their indexes if tabular)
+        theta = np.zeros((K, N, m.p), dtype = self.precision.theta)
+        theta[:] = theta0
+        traces = self._init_traces(m, S, K)
+
+        t0, save = 0, None
+        if checkpoint is not None:
+            info = {"algo" : type(self).__name__, "parameters" : self._parameters(m), "model" : m.fingerprint(),
+                    "T" : T, "N" : N, "K" : K, "stride" : recorder.stride}
+            if checkpoint.exists():
+                t0, S, theta, saved = checkpoint.load(info, rng, recorder)
+                traces.update(saved)
+                X = features.take(S)
+                monitor.t = t0
+            # The variables are read when the checkpoint is saved (the kernel updates them in place)
+            save = lambda t : checkpoint.save(t, info, S, theta, traces, rng, recorder)
+        if trajectories is not None:
+            _check_trajectories(trajectories, m, T, S, t0)
+        if t0 == 0:
+            recorder(0, theta[0] if single else theta, S)
+
+        # The compiled kernel does all the steps at once (one configuration only, it samples its own states)
+        kernel = self._kernel(m, traces, lambdas[0], alphas[0]) if single and self._compiled(m) and trajectories is None else None
+        if kernel is not None:
+            kernels.run(kernel[0], recorder, monitor, rng, m.mu, S, theta[0], kernel[1], t0 = t0,
+                        checkpoint = save, every = checkpoint.every if checkpoint else 0)
+
+        # Iterating over t (in parallel for the K configurations and the N particles)
+        block, start = (), t0
+        for t in range(t0, t0 if kernel is not None else T):
+            tic = monitor.tic()
+            if t - start >= len(block):
+                # Next states of the following steps (same for all the configurations)
+                block, start = self._next_states(m, t, T, S, rng, trajectories, checkpoint), t
+            S_next = np.asarray(block[t - start], dtype = S.dtype)
+            X_next = features.take(S_next)
+            rho = gather(m.phi, S, S_next) # Importance sampling ratio of the transition
+            tic = monitor.lap("sampling", tic)
+
+            inactive = rho == 0
+            if self.compact is None or np.count_nonzero(inactive) <= (1 - self.compact) * N:
+                self._update_traces(m, t, traces, S, S_next, X, rho, lambdas)
+                tic = monitor.lap("traces", tic)
+
+                delta = self._delta(m, theta, S, S_next, X, X_next)
+                theta = self._update_theta(m, traces, theta, delta, S, S_next, X, X_next, rho, alphas)
+            else:
+                # Compaction : only the active particles (rho != 0) are updated
+                active = np.flatnonzero(~inactive)
+                s, s_next, x, x_next, r = S[active], S_next[active], X[active], X_next[active], rho[active]
+                sub = {key : _particles(trace, active) for key, trace in traces.items()}
+                self._update_traces(m, t, sub, s, s_next, x, r, lambdas)
+                self._skip(m, traces, inactive, S_next)
+                tic = monitor.lap("traces", tic)
+
+                theta_active = theta[:, active]
+                delta = self._delta(m, theta_active, s, s_next, x, x_next)
+                theta[:, active] = self._update_theta(m, sub, theta_active, delta, s, s_next, x, x_next, r, alphas)
+                for key, trace in sub.items(): # The hooks can replace the traces of the active particles
+                    _particles(traces[key], active, trace)
+            tic = monitor.lap("theta", tic)
+
+            S, X = S_next, X_next
+            recorder(t+1, theta[0] if single else theta, S)
+            monitor.lap("record", tic)
+            monitor.step(t+1)
+            if save is not None and (t+1) % checkpoint.every == 0:
+                save(t+1)
+
+        monitor.end()
+
+    def _features(self, model):
+        '''
+            Return the features of the model (see features.py) with the dtype of the precision (cached by the model)
+        '''
+        dtype = self.precision.features
+        return model.derived(("features", dtype.str), lambda : get_features(model.features, dtype))
+
+    def _next_states(self, model, t, T, S, rng, trajectories = None, checkpoint = None):
+        '''
+            Return the states of the particles after the step t and the following ones (steps, N) :
+            the rest of the trajectories if given, else a block of _sample of at most 2**20 states.
+            A block stops at the steps of the checkpoint so the rng saved has drawn exactly the steps done.
+        '''
+        if trajectories is not None:
+            return trajectories.states[t+1:T+1]
+        steps = min(T - t, max(1, 2**20 // len(S)))
+        if checkpoint is not None:
+            steps = min(steps, checkpoint.every - t % checkpoint.every)
+        return self._sample(model, S, steps, rng)
+
+    def _sample(self, model, S, steps, rng):
+        '''
+            Return the next states of the particles in S for the next steps (steps, N) (the behavior policy by default)
+            They are the same as steps calls of mu.parallel_steps with rng
+        '''
+        return model.mu.trajectories(S, steps, rng = rng).states[1:]
+
+    def _delta(self, model, theta, S, S_next, X, X_next):
+        '''
+            Return the TD error of each configuration and particle (K, N) :
+                delta = R + gamma_next theta^T X_next - theta^T X
+        '''
+        features = self._features(model)
+        return model.reward(S, S_next)\
+                + model.discounts[S_next] * features.value(theta, X_next)\
+                - features.value(theta, X)
+
+    def _init_traces(self, model, S, K):
+        '''
+            Return the traces of the algorithm at t=0 (a dict, empty by default)
+            A trace is an array (N,) shared by the configurations or (K, N, p).
+        '''
+        return {}
+
+    def _skip(self, model, traces, inactive, S_next):
+        '''
+            Update in place the traces of the particles inactive (boolean mask) whose transition
+            has a zero importance sampling ratio, theta is not changed (nothing by default)
+        '''
+        pass
+
+    def _update_traces(self, model, t, traces, S, S_next, X, rho, lambdas):
+        '''
+            Update the traces in place before the update of theta (nothing by default)
+            rho is the importance sampling ratio of the transition S -> S_next, lambdas is (K, n)
+        '''
+        pass
+
+    def _update_theta(self, model, traces, theta, delta, S, S_next, X, X_next, rho, alphas):
+        '''
+            Return the new theta (K, N, p) from the TD error delta (K, N), alphas is (K,)
+        '''
+        raise NotImplementedError("{} does not implement the update of theta".format(type(self).__name__))
+
+    def _kernel(self, model, traces, lambdas, alpha):
+        '''
+            Return (kernel, args) to run the steps with a compiled kernel (see kernels.run), None if there is none.
+            The traces of the first configuration can be given to the kernel to be updated in place.
+        '''
+        return None
+
+
+
+def _check_trajectories(trajectories, model, T, S, t0 = 0):
+    '''
+        Raise a ValueError if the trajectories can not be the next states of the run (policy, steps or particles)
+    '''
+    if trajectories.policy != model.mu._key[0]:
+        raise ValueError("The trajectories have not been sampled from the behavior policy of the model")
+    if trajectories.T < T or trajectories.N != len(S):
+        raise ValueError("The trajectories have {} steps for {} particles ({} steps for {} particles are needed)".format(trajectories.T, trajectories.N, T, len(S)))
+    if np.any(trajectories.states[t0] != S):
+        raise ValueError("The trajectories do not start from the states of the run")
+
+
+
+def _particles(trace, idx, value = None):
+    '''
+        Return the particles idx of a trace ((N,) or (K, N, p)), or set them to value
+    '''
+    where = idx if trace.ndim == 1 else (slice(None), idx)
+    if value is None:
+        return trace[where]
+    trace[where] = value
+
+
+
+def _lambda_returns(model, lambdas):
+    '''
+        Return (a, b, a_features, r) for the key matrices of the algorithms with lambda returns :
+            a = Id - P_pi Gamma and b = Id - P_pi Gamma Lambda so P_pi_lambda = Id - b^-1 a
+            a_features = b^-1 a features and r = b^-1 r_pi
+        The inverses are replaced by linear solves so it works with sparse matrices
+        (b^-1 is identity if all lambdas are zero)
+    '''
+    sparse = model.sparse or sp.issparse(model.pi.P)
+    Id = identity(model.n, sparse)
+
+    a = Id - model.pi.P @ model.gammas
+    b = Id - model.pi.P @ model.gammas @ diag(lambdas, sparse)
+
+    a_features = a @ model.features
+    r_pi = model.r_pi
+    if np.any(lambdas):
+        a_features = solve(b, a_features)
+        r_pi = solve(b, r_pi)
+    return a, b, a_features, r_pi
+
+
+
+class OffTD(AbstractTD):
+
+    name = "offTD"
+
+    def _update_theta(self, model, traces, theta, delta, S, S_next, X, X_next, rho, alphas):
+        # Iterate theta (equation 1), lambdas are not used by TD(0)
+        return self._features(model).scatter_update(theta, X, alphas[:, None] * rho * delta)
+
+    def _kernel(self, model, traces, lambdas, alpha):
+        m = model
+        args = (kernels.dense(m.features, self.precision.features), kernels.rewards(m), kernels.dense(m.phi), kernels.dense(m.discounts), float(alpha))
+        return kernels.offtd_steps, args
+
+    def _emphasis(self, model):
+        return np.ones(model.n), np.zeros(model.n), np.zeros(model.n)
+
+
+    def _key_matrixes(self, model):
         '''
             Compute the matrix A and b for the model
+            The products use @ to work with dense and sparse matrices (A is sparse if the features are)
         '''
-        Id = np.eye(model.n)
-        
-        gammas = np.diag(model.discounts)
-        
+        sparse = model.sparse or sp.issparse(model.pi.P)
+        Id = identity(model.n, sparse)
+
         # Computing A
         # First P_pi_lambda
-        A = Id - np.dot(model.pi.P, gammas)
-        A = np.dot(model.mu.D, A)
-        A = np.dot(np.dot(model.features.transpose(), A), model.features)
-        
+        A = Id - model.pi.P @ model.gammas
+        A = model.mu.D @ A
+        A = model.features.transpose() @ A @ model.features
+
         # Computing B
-        r_pi = np.sum(model.pi.P * model.R, axis = 1)
-        B = np.dot(np.dot(model.mu.D, model.features).transpose(), r_pi)    
-            
-        return A, B    
-    
-    
-    
-class EmphaticTD(AbstractTD):
-    
-    def run(self, model, T, N = 1, verbose = True):
+        B = model.D_features.transpose() @ model.r_pi
+
+        return A, B
+
+
+
+class OffTDLambda(AbstractTD):
+    '''
+        Off-policy TD(lambda) with per-decision importance sampling :
+            e_t = rho_t (gamma_t lambda_t e_t-1 + X_t)
+            theta_t+1 = theta_t + alpha delta_t e_t
+        It is the emphatic TD with M_t = 1 (and OffTD if lambda is 0), it can diverge off-policy.
+    '''
+
+    name = "offTD(lambda)"
+
+    def _init_traces(self, model, S, K):
+        return {"e" : np.zeros((K, len(S), model.p), dtype = self.precision.theta)}
+
+    def _update_traces(self, model, t, traces, S, S_next, X, rho, lambdas):
+        e = custom_mult(traces["e"], rho * model.discounts[S] * lambdas[:, S])
+        traces["e"] = self._features(model).scatter_update(e, X, rho)
+
+    def _skip(self, model, traces, inactive, S_next):
+        traces["e"][:, inactive] = 0
+
+    def _update_theta(self, model, traces, theta, delta, S, S_next, X, X_next, rho, alphas):
+        return theta + custom_mult(traces["e"], alphas[:, None] * delta)
+
+    def _emphasis(self, model):
+        return np.ones(model.n), np.zeros(model.n), self._get_lambda(model)
+
+    def _key_matrixes(self, model):
         '''
-         Compute the emphatic TD with T period for the model.
-         It can do it for N particles in parallel.
+            Compute the matrix A and b for the model :
+                A = features^T D_mu (Id - P_pi_lambda) features and b = features^T D_mu b^-1 r_pi
         '''
-        # Shortcut
+        a, b, a_features, r_pi = _lambda_returns(model, self._get_lambda(model))
+        return model.D_features.transpose() @ a_features, model.D_features.transpose() @ r_pi
+
+
+
+class EmphaticTD(AbstractTD):
+
+    name = "emphatic TD"
+
+    def _init_traces(self, model, S, K):
+        # F does not depend on alpha and lambda, it is shared by the configurations
+        return {"F" : model.I[S].astype(self.precision.accumulate), "E" : np.zeros((K, len(S), model.p), dtype = self.precision.theta)}
+
+    def _update_traces(self, model, t, traces, S, S_next, X, rho, lambdas):
+        m = model
+        F, E = traces["F"], traces["E"]
+        lambdas_S = lambdas[:, S] # (K, N)
+
+        # Compute M (equation 19)
+        M = lambdas_S * m.I[S] + (1 - lambdas_S) * F
+
+        # Compute E (equation 18)
+        # Use custom_mult to multiply accross the particle (E is zero for t = 0)
+        E = self._features(m).scatter_update(custom_mult(E, rho * m.discounts[S] * lambdas_S), X, rho * M)
+
+        # Compute F of the next step (equation 20)
+        F = rho * m.discounts[S_next] * F + m.I[S_next]
+        traces.update(F = F, E = E)
+
+    def _skip(self, model, traces, inactive, S_next):
+        # rho = 0 : E is zero and F restarts from the interest
+        traces["E"][:, inactive] = 0
+        traces["F"][inactive] = model.I[S_next[inactive]]
+
+    def _update_theta(self, model, traces, theta, delta, S, S_next, X, X_next, rho, alphas):
+        # Iterate theta (equation 17)
+        return theta + custom_mult(traces["E"], alphas[:, None] * delta)
+
+    def _kernel(self, model, traces, lambdas, alpha):
         m = model
+        args = (traces["E"][0], traces["F"], kernels.dense(m.features, self.precision.features), kernels.rewards(m), kernels.dense(m.phi),
+                kernels.dense(m.discounts), kernels.dense(m.I), kernels.dense(lambdas), float(alpha))
+        return kernels.emphatic_steps, args
+
+    def _emphasis(self, model):
         lambdas = self._get_lambda(model)
-        
-        
-        # Init memory
-        theta = np.zeros((T+1, N, m.p))
-        F = np.zeros((T+1, N))
-        M = np.zeros(N)
-        E = np.zeros((T+1, N, m.p))
-        S = np.zeros((T+1, N), dtype = np.int)
-        
-        # Set t=0
-        S[0] = m.S0
-        F[0] = m.I[S[0]]
-        theta[0] = m.theta0
-        
-        # Iterating over t (in parallel for the N particles)
-        for t in range(T):
-            if verbose and (t % 999 == 0):
-                print("Computing emphatic TD... ({}/{})".format(t+1, T), end = "\r")
-            S[t+1] = m.mu.parallel_steps(S[t]) # Pick next step
-            
-             # Compute F (equation 20)
-            if t > 0:
-                F[t] = m.phi[S[t-1], S[t]] * m.discounts[S[t]] * F[t-1] + m.I[S[t]]
-            
-            # Compute M (equation 19)
-            M = lambdas[S[t]] * m.I[S[t]] + (1 - lambdas[S[t]]) * F[t]
-            
-            # Compute E (equation 18)
-            # Use custom_mult to multiply accross the particle
-            E[t] = custom_mult(m.features[S[t]], m.phi[S[t], S[t+1]] * M) # (E for t = 0)
-            if t > 0:
-                E[t] += custom_mult(E[t-1], m.phi[S[t], S[t+1]] * m.discounts[S[t]] * lambdas[S[t]])
-                
-            # Iterate theta (equation 17)
-            # delta is the parathesis of equation 17
-            delta = m.R[S[t], S[t+1]]\
-                    + m.discounts[S[t+1]] * np.sum(theta[t] * m.features[S[t+1]], axis = 1)\
-                    - np.sum(theta[t] * m.features[S[t]], axis = 1)
-        
-            theta[t+1] = theta[t] + custom_mult(E[t], self.alpha * delta)
-        
-        if verbose:
-            print("emphatic TD has been computed for {} steps and {} particles.".format(T, N))  
-            
-        return theta
-            
-    
-    def key_matrixes(self, model):
+        return lambdas * model.I, 1 - lambdas, lambdas
+
+
+    def _key_matrixes(self, model):
         '''
             Compute the matrix A and b for the model
+            The inverses are replaced by linear solves so it works with sparse matrices :
+                P_pi_lambda = Id - b^-1 a (b and a below)
+                m = (Id - P_pi_lambda^T)^-1 i = b^T (a^T)^-1 i
+            a does not depend on lambdas so its factorization is reused across the lambdas
         '''
-        Id = np.eye(model.n)
-        
+        sparse = model.sparse or sp.issparse(model.pi.P)
         i = model.mu.d*model.I
-        gammas = np.diag(model.discounts)
-        lambdas = np.diag(self._get_lambda(model))
-        
-        # Computing A
+
         # First P_pi_lambda
-        a = Id - np.dot(model.pi.P, gammas)
-        b = Id - np.dot(np.dot(model.pi.P, gammas), lambdas)
-        b = np.linalg.inv(b)
-        P_pi_lambda = Id - np.dot(b, a)
-        
+        a, b, a_features, r_pi = _lambda_returns(model, self._get_lambda(model))
+
         # Then M
-        m = np.dot(np.linalg.inv(Id - P_pi_lambda.transpose()), i)
-        M = np.diag(m)
-        
+        m = b.transpose() @ solve(a, i, transpose = True)
+        M = diag(m, sparse)
+
         # Product to have A
-        A = np.dot(np.dot(M, b), a)
-        A = np.dot(np.dot(model.features.transpose(), A), model.features)
-        
+        A = model.features.transpose() @ M @ a_features
+
         # Computing B
-        B = np.dot(model.features.transpose(), np.dot(M, b))
-        r_pi = np.sum(model.pi.P * model.R, axis = 1)
-        B = np.dot(B, r_pi)
-            
-        return A, B
\ No newline at end of file
+        B = model.features.transpose() @ (m * r_pi)
+
+        return A, B
+
+
+
+class GradientTD(AbstractTD):
+    '''
+        Base of the gradient TD algorithms (GTD2 and TDC) with the linear TD(0) error.
+        They learn secondary weights w (same shape as theta) with the step size beta (alpha by default) :
+            w_t+1 = w_t + beta rho_t (delta_t - w_t^T X_t) X_t
+        lambdas are not used.
+        The key matrices are the ones of the joint vector (theta, w) (size 2p) with eta = beta / alpha,
+        their solution is the TD(0) solution for theta and w = 0.
+    '''
+
+    vectors = 2
+
+    def __init__(self, alpha, lambdas = 0, beta = None, backend = "numpy", compact = 0.4, precision = None):
+        AbstractTD.__init__(self, alpha, lambdas, backend = backend, compact = compact, precision = precision)
+        self.beta = alpha if beta is None else beta
+
+    def _parameters(self, model):
+        return (self.alpha, self.beta)
+
+    def _init_traces(self, model, S, K):
+        return {"w" : np.zeros((K, len(S), model.p), dtype = self.precision.theta)}
+
+    def _update_theta(self, model, traces, theta, delta, S, S_next, X, X_next, rho, alphas):
+        features = self._features(model)
+        w = traces["w"]
+        w_X = features.value(w, X) # (K, N)
+        theta = self._update_main(model, features, theta, delta, X, X_next, S_next, rho, w_X, alphas[:, None])
+        traces["w"] = features.scatter_update(w, X, self.beta * rho * (delta - w_X))
+        return theta
+
+    def _update_main(self, model, features, theta, delta, X, X_next, S_next, rho, w_X, alphas):
+        '''
+            Return the new theta from the TD error and w^T X_t (the secondary weights before their update)
+        '''
+        raise NotImplementedError()
+
+    def _blocks(self, model):
+        '''
+            Return the TD(0) key matrices A, b and C = features^T D_mu features
+        '''
+        A, b = OffTD._key_matrixes(self, model)
+        C = model.features.transpose() @ model.D_features
+        return A, b, C
+
+    def _joint(self, blocks, b_theta, b_w):
+        '''
+            Assemble the key matrices of (theta, w) from the blocks [[A_theta_theta, A_theta_w], [A_w_theta, A_w_w]]
+        '''
+        if any(sp.issparse(X) for row in blocks for X in row):
+            blocks = [[sp.csr_matrix(X) for X in row] for row in blocks]
+            return sp.bmat(blocks, format = "csr"), np.concatenate([b_theta, b_w])
+        return np.block([[np.asarray(X) for X in row] for row in blocks]), np.concatenate([b_theta, b_w])
+
+
+
+class GTD2(GradientTD):
+    '''
+        GTD2 (Sutton et al. 2009) :
+            theta_t+1 = theta_t + alpha rho_t (X_t - gamma_t+1 X_t+1) w_t^T X_t
+    '''
+
+    name = "GTD2"
+
+    def _update_main(self, model, features, theta, delta, X, X_next, S_next, rho, w_X, alphas):
+        theta = features.scatter_update(theta, X, alphas * rho * w_X)
+        return features.scatter_update(theta, X_next, -alphas * rho * model.discounts[S_next] * w_X)
+
+    def _key_matrixes(self, model):
+        '''
+            Compute the matrix A and b of (theta, w) for the model :
+                A = [[0, -A_TD^T], [eta A_TD, eta C]] and b = [0, eta b_TD]
+        '''
+        A, b, C = self._blocks(model)
+        eta = self.beta / self.alpha
+        zeros = sp.csr_matrix(A.shape) if sp.issparse(A) else np.zeros(A.shape)
+        return self._joint([[zeros, -A.transpose()], [eta * A, eta * C]], np.zeros(len(b)), eta * b)
+
+
+
+class TDC(GradientTD):
+    '''
+        TDC or linear TD with gradient correction (Sutton et al. 2009) :
+            theta_t+1 = theta_t + alpha rho_t (delta_t X_t - gamma_t+1 X_t+1 w_t^T X_t)
+    '''
+
+    name = "TDC"
+
+    def _update_main(self, model, features, theta, delta, X, X_next, S_next, rho, w_X, alphas):
+        theta = features.scatter_update(theta, X, alphas * rho * delta)
+        return features.scatter_update(theta, X_next, -alphas * rho * model.discounts[S_next] * w_X)
+
+    def _key_matrixes(self, model):
+        '''
+            Compute the matrix A and b of (theta, w) for the model :
+                A = [[A_TD, C - A_TD^T], [eta A_TD, eta C]] and b = [b_TD, eta b_TD]
+        '''
+        A, b, C = self._blocks(model)
+        eta = self.beta / self.alpha
+        return self._joint([[A, C - A.transpose()], [eta * A, eta * C]], b, eta * b)
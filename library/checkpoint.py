@@ -0,0 +1,84 @@
+#
+# Checkpoints of the runs
+# The whole state of a simulation (step, states S, theta, traces, RNG and records) is saved every k steps
+# in a binary file (.npz), so a run interrupted (preemptible node, crash, ...) can be resumed bit for bit.
+#
+
+import os
+import pickle
+
+import numpy as np
+
+
+
+class Checkpoint(object):
+    '''
+        Save the state of a run in the file path every k steps.
+        Given to run (checkpoint argument), the run starts from the file if it exists and gives
+        the same results as the run without interruption (same rng and same backend : the compiled kernels
+        do not sum in the same order as NumPy).
+        The records kept by the run are saved too, but the callbacks are not called again for the steps
+        before the checkpoint (and a RunWriter must not be created again, its files are reused).
+    '''
+
+    def __init__(self, path, every = 10000):
+        self.path = path if path.endswith(".npz") else path + ".npz"
+        self.every = max(int(every), 1)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def remove(self):
+        ''' Delete the file (for example once the run is done) '''
+        if self.exists():
+            os.remove(self.path)
+
+    def save(self, t, info, S, theta, traces, rng, recorder):
+        '''
+            Write the state after the step t (the file is replaced atomically)
+            info is a dict of values identifying the run (checked when it is loaded)
+        '''
+        state = rng.bit_generator.state if rng is not None else np.random.get_state()
+        arrays = {
+            "t" : np.array(t),
+            "info" : _bytes(info),
+            "rng" : _bytes(state),
+            "S" : S,
+            "theta" : theta,
+        }
+        arrays.update(("trace_" + key, trace) for key, trace in traces.items())
+        arrays.update(("recorder_" + key, value) for key, value in recorder.state().items())
+
+        tmp = self.path[:-len(".npz")] + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.path)
+
+    def load(self, info, rng, recorder):
+        '''
+            Read the file : the rng (a Generator or None for the global state) and the recorder are restored,
+            return (t, S, theta, traces).
+            Raise a ValueError if the file is not a checkpoint of the same run (info).
+        '''
+        with np.load(self.path) as f:
+            saved = _object(f["info"])
+            if saved != info:
+                raise ValueError("The checkpoint {} is not the one of this run ({} != {})".format(self.path, saved, info))
+
+            state = _object(f["rng"])
+            if rng is not None:
+                rng.bit_generator.state = state
+            else:
+                np.random.set_state(state)
+
+            recorder.restore({key[len("recorder_"):] : f[key] for key in f.files if key.startswith("recorder_")})
+            traces = {key[len("trace_"):] : f[key] for key in f.files if key.startswith("trace_")}
+            return int(f["t"]), f["S"], f["theta"], traces
+
+
+
+def _bytes(obj):
+    ''' Pickle an object in an array of bytes (stored in the .npz without allow_pickle) '''
+    return np.frombuffer(pickle.dumps(obj), dtype = np.uint8)
+
+def _object(array):
+    return pickle.loads(array.tobytes())
@@ -0,0 +1,85 @@
+#
+# Robust estimators across the particles
+# X has the particles on the first axis : (N, ...) for example (N, T, p) for a trajectory.
+# The estimators work chunk by chunk on the second axis (the steps) so X can be a memory-mapped array.
+#
+
+import numpy as np
+from scipy.stats import trim_mean
+
+
+
+def _rng(rng = None):
+    ''' numpy Generator from a seed or a Generator (None is the global numpy random state) '''
+    if rng is None or isinstance(rng, np.random.Generator):
+        return np.random if rng is None else rng
+    return np.random.default_rng(rng)
+
+
+def _chunks(X, chunk = None):
+    '''
+        Slices of the second axis of X with about 1e7 values each (all of X if it has one axis)
+    '''
+    if X.ndim < 2:
+        return [slice(None)]
+    T = X.shape[1]
+    if chunk is None:
+        chunk = max(1, int(1e7 // max(1, X.size // T)))
+    return [slice(t, t + chunk) for t in range(0, T, chunk)]
+
+
+def _by_chunk(f, X, chunk = None):
+    ''' Apply f (reducing the first axis) chunk by chunk on the second axis of X '''
+    slices = _chunks(X, chunk)
+    if len(slices) == 1:
+        return f(np.asarray(X))
+    return np.concatenate([f(np.asarray(X[:, s])) for s in slices], axis = 0)
+
+
+
+def groups(N, K = 10, rng = None):
+    '''
+        Split N particles in K groups of equal size (up to one) after a random permutation.
+        Return (order, starts) : the particles sorted by group and the first index of each group in order.
+    '''
+    K = max(1, min(K, N))
+    order = _rng(rng).permutation(N)
+    starts = np.linspace(0, N, K + 1).astype(int)[:-1]
+    return order, starts
+
+
+def group_means(X, order, starts):
+    '''
+        Mean of X in each group (see groups) : shape (K, ...)
+    '''
+    sums = np.add.reduceat(np.asarray(X)[order], starts, axis = 0)
+    counts = np.diff(np.append(starts, len(order)))
+    return sums / counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+
+def mom(X, K = 10, rng = None, chunk = None):
+    '''
+        Median of means of X across the particles (first axis) with K groups.
+        The groups are drawn with a permutation from rng (seed or Generator) and the group means
+        are computed with a single np.add.reduceat, chunk steps at a time.
+    '''
+    order, starts = groups(len(X), K, rng)
+    return _by_chunk(lambda x : np.median(group_means(x, order, starts), axis = 0), X, chunk)
+
+
+def trimmed_mean(X, proportion = 0.1, chunk = None):
+    '''
+        Mean of X across the particles without the proportion lowest and highest values
+    '''
+    return _by_chunk(lambda x : trim_mean(x, proportion, axis = 0), X, chunk)
+
+
+def quantiles(X, q = (0.25, 0.5, 0.75), chunk = None):
+    '''
+        Quantiles q of X across the particles : shape (len(q), ...) (or the shape of X[0] for a single q)
+    '''
+    single = np.ndim(q) == 0
+    q = np.atleast_1d(q)
+    res = _by_chunk(lambda x : np.moveaxis(np.quantile(x, q, axis = 0), 0, -1), X, chunk) # q last to concatenate on the steps
+    res = np.moveaxis(res, -1, 0)
+    return res[0] if single else res
@@ -0,0 +1,161 @@
+#
+# Expected updates of the TD algorithms (dynamic programming instead of particles)
+# The expectations over the trajectories of the behavior policy mu are computed state by state with the recursions
+# of the traces : the follow-on trace F, the eligibility trace E and their second moments.
+# With rho the importance sampling ratio the first moments follow mu.P rho (pi.P if mu covers pi) and the second
+# moments follow Q = mu.P rho^2 : they can grow even if the first ones do not (that is why F can have an infinite variance).
+#
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from collections import defaultdict
+
+from utils import multiply, row_sums, identity, diag
+from solvers import solve
+
+
+
+def _dot(P, y):
+    ''' P^T y for a dense or a sparse P (y is (n,) or (n, p)) '''
+    return np.asarray(P.transpose() @ y)
+
+
+def _radius(X):
+    ''' Spectral radius of X (dense or sparse) '''
+    if sp.issparse(X) and X.shape[0] > 2:
+        return float(np.abs(spla.eigs(X, k = 1, which = "LM", return_eigenvectors = False)[0]))
+    X = X.toarray() if sp.issparse(X) else X
+    return float(np.max(np.abs(np.linalg.eigvals(X))))
+
+
+def _td_errors(model, W, squared = False):
+    '''
+        Return errors(values) : the sum over s' of W(s, s') delta(s, s') (or delta(s, s')^2 if squared) for each state s,
+        with delta(s, s') = R(s, s') + gamma(s') values(s') - values(s) (the sums of W R^k are computed once)
+    '''
+    R, gammas = model.R, model.discounts
+    w0 = row_sums(W)
+    if np.ndim(R) == 1:
+        wR, wR2 = np.asarray(W @ R).ravel(), np.asarray(W @ R**2).ravel()
+        WR = lambda u : np.asarray(W @ (R * u)).ravel()
+    else:
+        W_R = multiply(W, R)
+        wR, wR2 = row_sums(W_R), row_sums(multiply(W_R, R))
+        WR = lambda u : np.asarray(W_R @ u).ravel()
+
+    def errors(values):
+        u = gammas * values
+        c1 = wR + np.asarray(W @ u).ravel() # sum of W (R + gamma' values')
+        if not squared:
+            return c1 - values * w0
+        c2 = wR2 + 2 * WR(u) + np.asarray(W @ u**2).ravel()
+        return np.maximum(c2 - 2 * values * c1 + values**2 * w0, 0) # Remove the round-off negative values
+    return errors
+
+
+
+def expected_run(model, T, alpha, lambdas, a, b, times = None):
+    '''
+        Expected trajectory of an algorithm whose emphasis is M_t = a[S_t] + b[S_t] F_t with the traces
+            F_0 = I[S_0] and F_t+1 = rho_t gamma_t+1 F_t + I[S_t+1]        (follow-on)
+            E_t = rho_t (gamma_t lambda_t E_t-1 + M_t X_t)                  (eligibility)
+            theta_t+1 = theta_t + alpha delta_t E_t
+        OffTD is a = 1, b = 0 and lambda = 0, the emphatic TD is a = lambda I and b = 1 - lambda.
+        A step is the expected update given theta_t : theta_t+1 = theta_t + alpha (b_t - A_t theta_t) where A_t and b_t are
+        the key matrices with the distribution of the states and the expected traces of the step t (from S0), they tend
+        to the ones of optimal_run (if mu covers pi). The moments of the traces are exact but theta is the mean-field one (the correlation
+        between theta and the traces is neglected, it is of order alpha).
+        Return (thetas, info) for the steps in times (all the steps from 0 to T by default) : thetas is (len(times), p)
+        and info is a dict of arrays (len(times),) :
+            F_mean, F_var : mean and variance of the follow-on trace F_t
+            update_second : second moment E[|alpha delta_t E_t|^2] of the update of the step t given theta_t
+            update_var : its variance (trace of the covariance)
+        A step costs O(nnz(P) p) and the features are used as a dense array (n, p).
+    '''
+    m = model
+    times = np.arange(T+1) if times is None else np.asarray(times, dtype = int)
+    positions = defaultdict(list)
+    for k, t in enumerate(times):
+        positions[t].append(k)
+
+    X = m.features.toarray() if sp.issparse(m.features) else np.asarray(m.features, dtype = float)
+    P = multiply(m.mu.P, m.phi) # pi.P on the transitions of mu
+    Q = multiply(P, m.phi)
+    gammas, I = m.discounts, m.I
+    decay = gammas * lambdas
+    norms = np.sum(X**2, axis = 1)
+    errors, squared_errors = _td_errors(m, P), _td_errors(m, Q, squared = True)
+
+    # Distribution of S_t, E[F_t 1{S_t = s}] and E[F_t^2 1{S_t = s}]
+    p = np.zeros(m.n)
+    p[m.S0] = 1
+    f, g = I * p, I**2 * p
+    # With w_t = gamma_t lambda_t E_t-1 + M_t X_t (E_t = rho_t w_t) : E[w_t 1], E[F_t w_t 1] and E[|w_t|^2 1]
+    U, C, v = np.zeros((m.n, m.p)), np.zeros((m.n, m.p)), np.zeros(m.n)
+
+    theta = np.array(m.theta0, dtype = float)
+    thetas = np.zeros((len(times), m.p))
+    info = {key : np.zeros(len(times)) for key in ("F_mean", "F_var", "update_second", "update_var")}
+    for t in range(times.max() + 1 if len(times) else 0):
+        # Moments of E_t-1 at the state S_t
+        EE = _dot(P, U) # E[E_t-1 1]
+        FE = gammas[:, None] * _dot(Q, C) + I[:, None] * EE # E[F_t E_t-1 1]
+        EE2 = _dot(Q, v) # E[|E_t-1|^2 1]
+
+        # Moments of M_t and of the traces of the step t
+        M1, M2, FM = a * p + b * f, a**2 * p + 2 * a * b * f + b**2 * g, a * f + b * g
+        EME = a[:, None] * EE + b[:, None] * FE # E[M_t E_t-1 1]
+        v = decay**2 * EE2 + 2 * decay * np.sum(EME * X, axis = 1) + M2 * norms
+        U = decay[:, None] * EE + M1[:, None] * X
+        C = decay[:, None] * FE + FM[:, None] * X
+
+        # Expected update and its second moment given theta
+        values = X.dot(theta)
+        mean = alpha * U.transpose().dot(errors(values))
+        second = alpha**2 * v.dot(squared_errors(values))
+
+        for k in positions.get(t, ()):
+            thetas[k] = theta
+            info["F_mean"][k] = f.sum()
+            info["F_var"][k] = g.sum() - f.sum()**2
+            info["update_second"][k] = second
+            info["update_var"][k] = second - mean.dot(mean)
+        theta = theta + mean
+
+        # Distribution and follow-on trace of the step t+1
+        Pf = _dot(P, f)
+        p = _dot(m.mu.P, p)
+        g = gammas**2 * _dot(Q, g) + 2 * gammas * I * Pf + I**2 * p
+        f = gammas * Pf + I * p
+
+    return thetas, info
+
+
+
+def follow_on(model):
+    '''
+        Stationary moments of the follow-on trace F under mu for each state (cached by the model) :
+            f = E[F_t 1{S_t = s}] solves (Id - Gamma pi.P^T) f = d_mu I (the follow-on weights of the emphatic TD)
+            g = E[F_t^2 1{S_t = s}] solves (Id - Gamma^2 Q^T) g = 2 Gamma I pi.P^T f + d_mu I^2
+        (pi.P is mu.P rho, the transitions of pi that mu can not do are never seen)
+        g is infinite if radius, the spectral radius of Gamma^2 Q^T, is at least 1 : the variance of F explodes.
+        Return a dict with f, g, radius, mean (E[F]) and var (the variance of F)
+    '''
+    return model.derived("follow_on", lambda : _follow_on(model))
+
+def _follow_on(model):
+    m = model
+    sparse = m.sparse or sp.issparse(m.pi.P)
+    Id = identity(m.n, sparse)
+    d, gammas, I = m.mu.d, m.discounts, m.I
+
+    P = multiply(m.mu.P, m.phi)
+    f = solve(Id - diag(gammas, sparse) @ P.transpose(), d * I)
+    G2_Q = diag(gammas**2, sparse) @ multiply(P, m.phi).transpose()
+    radius = _radius(G2_Q)
+    if radius < 1:
+        g = solve(Id - G2_Q, 2 * gammas * I * _dot(P, f) + d * I**2)
+    else:
+        g = np.full(m.n, np.inf)
+    return {"f" : f, "g" : g, "radius" : radius, "mean" : f.sum(), "var" : g.sum() - f.sum()**2}
@@ -0,0 +1,119 @@
+#
+# Features of the states seen by the runs
+# The algorithms only use the features of the particles through take, value and scatter_update,
+# so each representation does the products of a step its own way :
+#   Dense : an array (n, p)
+#   Sparse : a scipy.sparse matrix (n, p), only the non zero entries are read and updated
+#   Tabular : one-hot features (the state s has only the feature index[s] equal to 1, the identity is the tabular case),
+#             the features of the particles are their indexes (N,) so a step is O(N) instead of O(N p)
+# The matrix of the model (model.features) is still used for the key matrices and the MSVE.
+#
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import row_dot, _like
+
+
+
+class Dense(object):
+    '''
+        Dense features (n, p)
+    '''
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.n, self.p = matrix.shape
+
+    def take(self, S):
+        ''' Features of the particles in the states S : (N, p) '''
+        return self.matrix[S]
+
+    def value(self, theta, X):
+        '''
+            theta^T X for each particle : theta is (..., N, p) and X is given by take, the result is (..., N)
+        '''
+        return np.sum(theta * X, axis = -1)
+
+    def scatter_update(self, theta, X, scale):
+        '''
+            theta += scale X in place for each particle (scale is (..., N)) and return theta
+        '''
+        theta += X * _like(scale, theta)[..., None]
+        return theta
+
+
+
+class Sparse(Dense):
+    '''
+        Sparse features (n, p) as a scipy.sparse matrix (csr)
+    '''
+
+    def __init__(self, matrix):
+        Dense.__init__(self, sp.csr_matrix(matrix))
+
+    def value(self, theta, X):
+        return row_dot(X, theta)
+
+    def scatter_update(self, theta, X, scale):
+        X = X.tocoo()
+        X.sum_duplicates() # Each entry once so the in-place addition is safe
+        theta[..., X.row, X.col] += X.data * scale[..., X.row]
+        return theta
+
+
+
+class Tabular(object):
+    '''
+        One-hot features : the state s has the feature index[s] (state aggregation, the identity if index is range(n))
+        A particle is represented by its feature index so theta^T X is theta[index[s]]
+    '''
+
+    def __init__(self, index, p = None):
+        self.index = np.asarray(index)
+        self.n = len(self.index)
+        self.p = int(self.index.max()) + 1 if p is None else p
+
+    def take(self, S):
+        ''' Feature indexes of the particles in the states S : (N,) '''
+        return self.index[S]
+
+    def value(self, theta, X):
+        return theta[..., np.arange(len(X)), X]
+
+    def scatter_update(self, theta, X, scale):
+        theta[..., np.arange(len(X)), X] += _like(scale, theta)
+        return theta
+
+
+
+def one_hot(matrix):
+    '''
+        Return the feature index of each state if matrix (dense or sparse) is one-hot (a single 1 by row), else None
+    '''
+    if sp.issparse(matrix):
+        X = sp.csr_matrix(matrix)
+        X.sum_duplicates()
+        X.eliminate_zeros()
+        if np.all(np.diff(X.indptr) == 1) and np.all(X.data == 1):
+            return X.indices.copy()
+        return None
+    X = np.asarray(matrix)
+    index = np.argmax(X != 0, axis = 1)
+    ones = X[np.arange(len(X)), index] == 1
+    if np.all(ones) and np.all(np.count_nonzero(X, axis = 1) == 1):
+        return index
+    return None
+
+
+def get_features(matrix, dtype = None):
+    '''
+        Return the representation of the features matrix (n, p) of a model :
+        Tabular if it is one-hot, else Sparse or Dense with the dtype (the one of matrix by default)
+    '''
+    index = one_hot(matrix)
+    if index is not None:
+        return Tabular(index, matrix.shape[1])
+    if dtype is not None and matrix.dtype != dtype:
+        matrix = matrix.astype(dtype)
+    return Sparse(matrix) if sp.issparse(matrix) else Dense(matrix)
@@ -0,0 +1,143 @@
+#
+# Compiled kernels (Numba) for the inner loops of the TD algorithms
+# One kernel call advances every particle of several steps : sampling, traces and theta updates are fused.
+# Numba is optional : without it (or for sparse models) the algorithms use their NumPy loop.
+#
+
+import numpy as np
+import scipy.sparse as sp
+
+try:
+    import numba
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+
+
+def _jit(f):
+    ''' Compile f with numba if it is installed '''
+    return numba.njit(cache = True, nogil = True)(f) if NUMBA else f
+
+
+
+def available(model):
+    '''
+        True if the compiled kernels can run the model (numba installed and dense matrices)
+    '''
+    dense = not any(sp.issparse(X) for X in (model.features, model.R, model.phi, model.mu.P))
+    return NUMBA and dense
+
+
+def dense(X, dtype = np.float64):
+    ''' Contiguous copy of X for the kernels (float64 by default) '''
+    return np.ascontiguousarray(X, dtype = dtype)
+
+def rewards(model):
+    ''' Rewards of the transitions (n, n) for the kernels (a view without copy if R is the reward of the arriving states) '''
+    if np.ndim(model.R) == 1:
+        return np.broadcast_to(dense(model.R), (model.n, model.n))
+    return dense(model.R)
+
+
+
+@_jit
+def _sample(keys, states, s, u):
+    ''' Next state from s with the uniform u (see Policy._load_sampler) '''
+    return states[np.searchsorted(keys, s + u, side = "right")]
+
+
+@_jit
+def offtd_steps(t0, U, keys, states, S, theta, features, R, phi, discounts, alpha):
+    '''
+        len(U) steps of the off-policy TD(0) (equation 1) for every particle, in place
+        The particles with a zero importance sampling ratio are skipped
+    '''
+    N, p = theta.shape
+    for k in range(U.shape[0]):
+        for i in range(N):
+            s = S[i]
+            s_next = _sample(keys, states, s, U[k, i])
+            S[i] = s_next
+            if phi[s, s_next] == 0: # Nothing to learn from this transition
+                continue
+
+            v, v_next = 0., 0.
+            for j in range(p):
+                v += theta[i, j] * features[s, j]
+                v_next += theta[i, j] * features[s_next, j]
+            delta = R[s, s_next] + discounts[s_next] * v_next - v
+
+            scale = alpha * phi[s, s_next] * delta
+            for j in range(p):
+                theta[i, j] += features[s, j] * scale
+
+
+@_jit
+def emphatic_steps(t0, U, keys, states, S, theta, E, F, features, R, phi, discounts, I, lambdas, alpha):
+    '''
+        len(U) steps of the emphatic TD (equations 17 to 20) for every particle, in place
+        F is the follow-on trace of the current state of each particle (as in EmphaticTD)
+        The particles with a zero importance sampling ratio only reset E and F
+    '''
+    N, p = theta.shape
+    for k in range(U.shape[0]):
+        for i in range(N):
+            s = S[i]
+            s_next = _sample(keys, states, s, U[k, i])
+            S[i] = s_next
+
+            r = phi[s, s_next]
+            if r == 0: # E is zero, F restarts and theta does not change
+                for j in range(p):
+                    E[i, j] = 0.
+                F[i] = I[s_next]
+                continue
+
+            # M, E and delta (equations 19, 18 and 17)
+            M = lambdas[s] * I[s] + (1 - lambdas[s]) * F[i]
+            decay = r * discounts[s] * lambdas[s]
+            v, v_next = 0., 0.
+            for j in range(p):
+                E[i, j] = E[i, j] * decay + features[s, j] * (r * M)
+                v += theta[i, j] * features[s, j]
+                v_next += theta[i, j] * features[s_next, j]
+            delta = R[s, s_next] + discounts[s_next] * v_next - v
+
+            for j in range(p):
+                theta[i, j] += E[i, j] * (alpha * delta)
+
+            # F of the next state (equation 20)
+            F[i] = r * discounts[s_next] * F[i] + I[s_next]
+
+
+
+def run(kernel, recorder, monitor, rng, policy, S, theta, args, block = 2**20, t0 = 0, checkpoint = None, every = 0):
+    '''
+        Drive a kernel from the step t0 to the last step of the recorder : the uniforms are drawn by blocks
+        (at most block values) and the kernel is called between two records of the recorder (already called at t0).
+        If checkpoint is given it is also called as checkpoint(t) every k steps (the kernel stops there).
+        The uniforms are the same as the ones of Policy.parallel_steps for the same rng.
+        The monitor times the phases "sampling" (uniforms), "kernel" and "record".
+    '''
+    rng = np.random if rng is None else rng
+    N = len(S)
+    stops = recorder.times[recorder.times > t0]
+    if checkpoint is not None:
+        stops = np.union1d(stops, np.arange(t0 - t0 % every + every, recorder.T + 1, every))
+    t = t0
+    for stop in stops:
+        while t < stop:
+            steps = int(min(stop - t, max(1, block // N)))
+            tic = monitor.tic()
+            U = rng.random((steps, N))
+            tic = monitor.lap("sampling", tic)
+            kernel(t, U, policy._sampler_keys, policy._sampler_states, S, theta, *args)
+            monitor.lap("kernel", tic)
+            t += steps
+            monitor.step(t)
+        tic = monitor.tic()
+        recorder(t, theta, S) # Nothing is recorded if t is not a record step
+        monitor.lap("record", tic)
+        if checkpoint is not None and t % every == 0:
+            checkpoint(t)
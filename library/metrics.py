@@ -0,0 +1,70 @@
+#
+# Online metrics of the particles
+# They are updated during a run (callback of run) instead of being computed from the whole trajectory.
+#
+
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import get_rng
+from estimators import groups, group_means
+
+
+
+class OnlineMetrics(object):
+    '''
+        Metrics of the N particles computed every time theta is recorded during a run, give it as callback :
+            metrics = OnlineMetrics(model)
+            algo.run(model, T, N, stride = k, callback = metrics, keep = False)
+            metrics.result()
+        For each record it keeps :
+            msve_mean, msve_median : mean and median of the msve of the particles
+            theta_mean, theta_var : mean and variance of theta across the particles
+            theta_mom, msve_mom : median of means of theta (fixed random groups of particles) and its msve
+        The msve uses the quadratic form of Model.msve_quadratic, so a record needs O(N p + p^2)
+        working memory and never the (N, n) value estimates. Only the records are stored.
+    '''
+
+    def __init__(self, model, groups = 10, rng = None):
+        self.G, self.c, self.e = model.msve_quadratic()
+        self.groups = groups
+        self.rng = get_rng(rng)
+        self._groups = None
+        self.records = OrderedDict((key, []) for key in ("t", "msve_mean", "msve_median", "msve_mom", "theta_mean", "theta_var", "theta_mom"))
+
+    def msve(self, theta):
+        '''
+            msve of each row of theta (N, p) or of a single theta (p,)
+        '''
+        theta = np.asarray(theta, dtype = float)
+        G_theta = self.G.dot(theta.transpose()).transpose()
+        msve = np.sum(theta * G_theta, axis = -1) - 2 * theta.dot(self.c) + self.e
+        return np.maximum(msve, 0) # Remove the round-off negative values
+
+    def _group_means(self, theta):
+        '''
+            Mean of theta in each group of particles (the groups are drawn once for the run)
+        '''
+        if self._groups is None or len(self._groups[0]) != len(theta):
+            self._groups = groups(len(theta), self.groups, self.rng)
+        return group_means(theta, *self._groups)
+
+    def __call__(self, t, theta):
+        msve = self.msve(theta)
+        theta_mom = np.median(self._group_means(theta), axis = 0)
+
+        r = self.records
+        r["t"].append(t)
+        r["msve_mean"].append(np.mean(msve))
+        r["msve_median"].append(np.median(msve))
+        r["msve_mom"].append(self.msve(theta_mom))
+        r["theta_mean"].append(np.mean(theta, axis = 0))
+        r["theta_var"].append(np.var(theta, axis = 0))
+        r["theta_mom"].append(theta_mom)
+
+    def result(self):
+        '''
+            Return the records as a dict of arrays (the first axis is the record)
+        '''
+        return OrderedDict((key, np.array(values)) for key, values in self.records.items())
@@ -1,5 +1,8 @@
 import numpy as np
-from utils import to_array_of_vectors
+import scipy.sparse as sp
+from utils import to_array_of_vectors, multiply, fingerprint, custom_mult, diag, row_sums, gather
+from policies import BatchPolicy
+from operator import attrgetter
 from scipy.optimize import minimize
 
 class Model(object):
@@ -7,31 +10,125 @@ class Model(object):
          A class to store all the parameter of the model
          Features, policies (off ond on)
          Lambdas and discounts for the emphatic TD
+         The features and R can be scipy.sparse matrices (they are kept sparse)
+         R is the reward of each transition (n, n) or the reward when arriving in each state (n,)
+         The quantities derived from the parameters (phi, r_pi, key matrices, ...) are computed
+         when needed and cached until a parameter is set again (see derived)
     '''
     
+    # Setting one of these attributes clears the derived quantities (modifying an array in place does not, call invalidate)
+    PARAMETERS = ("features", "R", "pi", "mu", "I", "discounts", "v_pi")
+    
     def __init__(self, features, R, pi, theta0, S0, mu = None, I = None, discounts = None, v_pi = None):
         '''
            Set the parameters and compute other parameters to help  
         '''
         self.features = to_array_of_vectors(features) # Features for the state (the function assures it has good shape)
-        self.R = np.array(R) # The immediate reward for each state
+        self.R = sp.csr_matrix(R) if sp.issparse(R) else np.array(R) # The immediate reward for each transition or arriving state
         self.S0 = int(S0)
         self.theta0 = np.array(theta0)
         
         # Compute basic parameters
-        self.n = len(features) # Number of states
+        self.n = self.features.shape[0] # Number of states
         self.p = self.features.shape[1] # Dimension of the features
         
         # Compute policies
         self.pi = pi.fit(self) # The target policy
         self.mu = self.pi if mu is None else mu.fit(self) # The behavior policy (default is the target policy)
-        self.phi = np.divide(self.pi.P, self.mu.P, out=np.zeros_like(self.pi.P), where=self.mu.P!=0) # Importance sampling ratio
         
         # Other parameters with default
         self.I = np.ones(self.n)/self.n if I is None else np.array(I) # Intereset for each state (default is uniform)
         self.discounts = np.zeros(self.n) if discounts is None else np.array(discounts) # Discount rate for each state (default is zero for all)
         self.v_pi = None if v_pi is None else np.array(v_pi)
         
+    def __setattr__(self, name, value):
+        if name in self.PARAMETERS:
+            self.invalidate()
+        object.__setattr__(self, name, value)
+    
+    def __getstate__(self):
+        # The derived quantities are not sent to other processes
+        state = self.__dict__.copy()
+        state.pop("_derived", None)
+        return state
+    
+    def invalidate(self):
+        ''' Clear the derived quantities '''
+        self.__dict__.pop("_derived", None)
+    
+    def derived(self, key, compute):
+        '''
+            Return the derived quantity key (any hashable, for example the name of an algorithm and its parameters)
+            compute() is called at the first call only, the result is cached until a parameter of the model is set
+            or one of its policies is fitted to another matrix
+        '''
+        policies = (getattr(self.pi, "_key", None), getattr(self.mu, "_key", None))
+        cache = self.__dict__.setdefault("_derived", {})
+        if cache.get("policies") != policies:
+            cache.clear()
+            cache["policies"] = policies
+        if key not in cache:
+            cache[key] = compute()
+        return cache[key]
+    
+    @property
+    def phi(self):
+        ''' Importance sampling ratio pi.P / mu.P '''
+        return self.derived("phi", self._importance_ratio)
+    
+    @property
+    def r_pi(self):
+        ''' Expected reward from each state under pi '''
+        if np.ndim(self.R) == 1:
+            return self.derived("r_pi", lambda : np.asarray(self.pi.P @ self.R).ravel())
+        return self.derived("r_pi", lambda : row_sums(multiply(self.pi.P, self.R)))
+    
+    @property
+    def gammas(self):
+        ''' Diagonal matrix of the discounts (sparse if the features or pi are sparse) '''
+        return self.derived("gammas", lambda : diag(self.discounts, self.sparse or sp.issparse(self.pi.P)))
+    
+    @property
+    def D_features(self):
+        ''' D_mu features (rows of the features weighted by the stationary distribution of mu) '''
+        return self.derived("D_features", lambda : self.mu.D @ self.features)
+    
+    def reward(self, S, S_next):
+        ''' Rewards of the transitions S -> S_next of the particles '''
+        if np.ndim(self.R) == 1:
+            return self.R[S_next]
+        return gather(self.R, S, S_next)
+    
+    @property
+    def sparse(self):
+        ''' True if the model stores its features as a sparse matrix '''
+        return sp.issparse(self.features)
+        
+    def fingerprint(self):
+        '''
+            Hash of the parameters defining the dynamic of the model (to identify stored results)
+        '''
+        return fingerprint(self.features, self.R, self.pi.P, self.mu.P, self.I, self.discounts, np.array(self.S0), self.theta0)
+    
+    def start(self, N):
+        '''
+            Return the states (N,) and theta (N, p) of N particles at t = 0
+        '''
+        theta = np.zeros((N, self.p))
+        theta[:] = self.theta0
+        return np.full(N, self.S0, dtype = int), theta
+        
+    def _importance_ratio(self):
+        '''
+            Compute pi.P / mu.P (zero where mu.P is zero)
+        '''
+        if sp.issparse(self.pi.P) or sp.issparse(self.mu.P):
+            mu_inv = sp.csr_matrix(self.mu.P, copy = True)
+            mu_inv.eliminate_zeros()
+            mu_inv.data = 1 / mu_inv.data
+            return multiply(mu_inv, self.pi.P)
+        return np.divide(self.pi.P, self.mu.P, out=np.zeros_like(self.pi.P), where=self.mu.P!=0)
+        
 #
 # Utilities
 #        
@@ -42,31 +139,54 @@ class Model(object):
             Return x_min, min
         '''
         def msve(theta):
-            return np.sum((np.dot(self.features, theta) - self.v_pi)**2 * self.mu.d * self.I)
+            return np.sum((self.features.dot(theta) - self.v_pi)**2 * self.mu.d * self.I)
         m = minimize(msve, self.theta0)
         return m.x, m.fun
         
+    def msve_quadratic(self):
+        '''
+            Return G (p, p), c (p,) and e such that msve(theta) = theta G theta - 2 c theta + e
+            with W = diag(d_mu * I) : G = features^T W features, c = features^T W v_pi, e = v_pi^T W v_pi
+            The msve of a particle then costs O(p^2) instead of O(n p)
+        '''
+        if self.v_pi is None:
+            raise ValueError("v_pi must be defined to compute the msve !")
+        w = self.mu.d * self.I
+        W_features = custom_mult(self.features, w)
+        G = self.features.transpose() @ W_features # Sparse if the features are sparse
+        c = W_features.transpose() @ self.v_pi
+        e = np.sum(w * self.v_pi**2)
+        return G, np.asarray(c).ravel(), e
+        
     def msve(self, theta):
         '''
             Compute the MSVE for only one particle
         '''
         if self.v_pi is None:
             raise ValueError("v_pi must be defined to compute the msve !")
-        v_estimates = np.dot(theta, self.features.transpose())
+        v_estimates = self.features.dot(np.transpose(theta)).transpose()
         msve = ((v_estimates - self.v_pi)**2) * self.mu.d * self.I
         msve = np.sum(msve, axis = 1)
         return msve
     
-    def parallel_msve(self, thetas):
+    def parallel_msve(self, thetas, chunk = None):
         '''
             Compute the MSVE for multiple particles in parallel
+            thetas (T, N, p) is read chunk steps at a time (it can be a memory-mapped array),
+            by default the chunks keep the (chunk, N, n) estimates around 1e7 values.
         '''
         if self.v_pi is None:
             raise ValueError("v_pi must be defined to compute the msve !")
-        v_estimates = np.tensordot(self.features, thetas, axes = [[1], [2]])
-        v_estimates = np.moveaxis(v_estimates, 0, -1) # Change axis [S, T, N] -> [T, N, S]
-        msve = ((v_estimates - self.v_pi)**2) * self.mu.d * self.I
-        msve = np.sum(msve, axis = 2)
+        T, N, p = thetas.shape
+        chunk = max(1, int(1e7 // (N * self.n))) if chunk is None else chunk
+        
+        msve = np.zeros((T, N))
+        for t in range(0, T, chunk):
+            theta = np.asarray(thetas[t:t+chunk])
+            c = len(theta)
+            v_estimates = self.features.dot(theta.reshape((c*N, p)).transpose()) # Works for sparse features too
+            v_estimates = v_estimates.transpose().reshape((c, N, self.n)) # Change axis [S, T*N] -> [T, N, S]
+            msve[t:t+chunk] = np.sum(((v_estimates - self.v_pi)**2) * self.mu.d * self.I, axis = 2)
         #msve = np.linalg.norm((v_estimates - self.v_pi), axis = 2)
         return msve
 
@@ -74,8 +194,93 @@ class Model(object):
 
 
 
+class ModelBatch(Model):
+    '''
+        B models with the same number of states n and of features p run as one model :
+        the batch has B*n states (the states of the model b are b*n to (b+1)*n - 1) and its
+        matrices are block diagonal (sparse), so the algorithms advance the B*N particles in a single pass.
+        N particles are started in each model (start), the particles of the model b are b*N to (b+1)*N - 1.
+        The key matrices (optimal, optimal_run) must be computed on the models (batch.models).
+        tensor gives the parameters stacked as (B, n, p), (B, n, n) or (B, n) arrays.
+    '''
+
+    def __init__(self, models):
+        self.models = list(models)
+        self.B = len(self.models)
+        n, p = self.models[0].n, self.models[0].p
+        if any((model.n, model.p) != (n, p) for model in self.models):
+            raise ValueError("The models of a batch must have the same number of states and of features")
+        self.n_model = n # Number of states of each model
+
+        sparse = any(model.sparse for model in self.models)
+        features = sp.vstack([model.features for model in self.models], format = "csr") if sparse else self.tensor("features").reshape((self.B*n, p))
+        if all(np.ndim(model.R) == 1 for model in self.models):
+            R = self.tensor("R").ravel() # Rewards when arriving in each state of the batch
+        else:
+            R = sp.block_diag([sp.csr_matrix(np.broadcast_to(model.R, (n, n)) if np.ndim(model.R) == 1 else model.R) for model in self.models], format = "csr")
+        v_pi = None if any(model.v_pi is None for model in self.models) else self.tensor("v_pi").ravel()
+
+        super(ModelBatch, self).__init__(features, R, BatchPolicy([model.pi for model in self.models]), self.models[0].theta0, 0,
+                                         mu = BatchPolicy([model.mu for model in self.models]),
+                                         I = self.tensor("I").ravel(), discounts = self.tensor("discounts").ravel(), v_pi = v_pi)
+        self.S0 = np.array([model.S0 for model in self.models]) + n * np.arange(self.B) # Initial state of each model
+        self.theta0 = self.tensor("theta0") # (B, p)
+
+    def tensor(self, key):
+        '''
+            Return the parameter key (for example "features", "R", "phi", "mu.P" or "mu.d") of the models
+            stacked on a first axis of size B (dense)
+        '''
+        values = [attrgetter(key)(model) for model in self.models]
+        return np.stack([X.toarray() if sp.issparse(X) else np.asarray(X, dtype = float) for X in values])
+
+    def fingerprint(self):
+        return fingerprint(*[np.frombuffer(model.fingerprint().encode(), dtype = np.uint8) for model in self.models])
+
+    def start(self, N):
+        '''
+            Return the states (B*N,) and theta (B*N, p) of N particles in each model at t = 0
+        '''
+        return np.repeat(self.S0, N).astype(int), np.repeat(self.theta0, N, axis = 0)
+
+    def split(self, X, axis = 1):
+        '''
+            Split the particle axis (B*N) of X in (B, N), for example the thetas (T, B*N, p) of a run
+            become (T, B, N, p)
+        '''
+        X = np.asarray(X)
+        shape = X.shape[:axis] + (self.B, X.shape[axis] // self.B) + X.shape[axis+1:]
+        return X.reshape(shape)
+
+    def msve_quadratic(self):
+        raise NotImplementedError("The msve of a batch is computed particle by particle (see msve), not with a quadratic form")
+
+    def msve(self, theta):
+        '''
+            Compute the MSVE of the particles theta (B*N, p), each one in its model
+        '''
+        theta = self.split(theta, axis = 0)
+        return np.concatenate([model.msve(theta[b]) for b, model in enumerate(self.models)])
+
+    def parallel_msve(self, thetas, chunk = None):
+        '''
+            Compute the MSVE of the particles for multiple steps thetas (T, B*N, p), each one in its model
+        '''
+        T, N, p = thetas.shape
+        step = N // self.B
+        return np.concatenate([model.parallel_msve(thetas[:, b*step:(b+1)*step], chunk = chunk) for b, model in enumerate(self.models)], axis = 1)
+
+
+
+
 class Grid(Model):
-    def __init__(self, l_x, l_y, pi, theta0, S0, features = None, R = None, mu = None, I = None, discounts = None, v_pi = None):
+    def __init__(self, l_x, l_y, pi, theta0, S0, features = None, R = None, mu = None, I = None, discounts = None, v_pi = None, sparse = False):
+        '''
+            R is the reward when arriving in each cell (l_x, l_y), it is stored as a vector of the states.
+            If sparse is True the default features (identity) and the transition matrices are stored
+            as scipy.sparse matrices : the memory is O(n) and large grids can be built.
+            The default features are one-hot so the runs use them as tabular features (see features.py).
+        '''
         # Grid properties
         self.l_x = int(l_x)
         self.l_y = int(l_y)
@@ -83,8 +288,9 @@ class Grid(Model):
         
         # Convert for standard model (not 2D but 1D)
         S0 = self.coords_to_id(S0)
-        features = np.identity(self.n) if features is None else features
-        R = None if R is None else np.tile(R.reshape(self.n), self.n).reshape((self.n, self.n))
+        if features is None:
+            features = sp.identity(self.n, format = "csr") if sparse else np.identity(self.n)
+        R = None if R is None else np.array(R, dtype = float).reshape(self.n) # Reward when arriving in each state
         I = None if I is None else np.array(I).flatten()
         discounts = None if discounts is None else np.array(discounts).flatten()
         v_pi = None if v_pi is None else np.array(v_pi).flatten()
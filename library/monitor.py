@@ -0,0 +1,126 @@
+#
+# Instrumentation of the runs
+# A Monitor counts the steps, times the phases of a step (sampling, traces, theta, ...) when profiling
+# and calls hooks every k steps. The progress printed by the algorithms is one of these hooks.
+#
+
+import time
+from collections import OrderedDict
+
+
+
+class Monitor(object):
+    '''
+        Instrumentation of a run of T steps for N particles.
+        hooks is a list of functions hook(t, monitor) (or of pairs (hook, every) to call it every k steps),
+        they are also called once at the end with monitor.done set to True.
+        If profile is True the time spent in each phase of a step is accumulated in monitor.phases.
+    '''
+
+    def __init__(self, hooks = (), profile = False):
+        self.profile = profile
+        self.hooks = []
+        for hook in hooks:
+            hook, every = hook if isinstance(hook, tuple) else (hook, 1)
+            self.add_hook(hook, every)
+
+    def add_hook(self, hook, every = 1):
+        '''
+            Call hook(t, monitor) every k steps
+        '''
+        self.hooks.append((hook, max(int(every), 1)))
+        return self
+
+    def start(self, T, N, name = "TD", verbose = False):
+        '''
+            Reset the counters at the beginning of a run
+            If verbose the progress is printed (hook progress) during this run
+        '''
+        self.T, self.N, self.name = T, N, name
+        self._run_hooks = self.hooks + ([progress()] if verbose else [])
+        self.t = 0
+        self.done = False
+        self.phases = OrderedDict()
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        return self
+
+    #
+    # Timers of the phases (nothing is measured if profile is False)
+    #
+
+    def tic(self):
+        ''' Return the current time to start a phase (0 if not profiling) '''
+        return time.perf_counter() if self.profile else 0.
+
+    def lap(self, phase, tic):
+        '''
+            Add the time since tic to the phase and return the current time (the tic of the next phase)
+        '''
+        if not self.profile:
+            return 0.
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.) + now - tic
+        return now
+
+    #
+    # Counters and hooks
+    #
+
+    def step(self, t):
+        '''
+            Tell the monitor that the steps until t are done (the hooks due are called)
+        '''
+        previous, self.t = self.t, t
+        for hook, every in self._run_hooks:
+            if t // every > previous // every:
+                hook(t, self)
+
+    def end(self):
+        ''' End of the run : the hooks are called a last time with done = True '''
+        self.end_time = time.perf_counter()
+        self.done = True
+        for hook, every in self._run_hooks:
+            hook(self.t, self)
+
+    @property
+    def elapsed(self):
+        ''' Seconds since the beginning of the run '''
+        return (time.perf_counter() if self.end_time is None else self.end_time) - self.start_time
+
+    @property
+    def steps_per_second(self):
+        return self.t / self.elapsed if self.elapsed > 0 else 0.
+
+    @property
+    def particle_steps_per_second(self):
+        return self.steps_per_second * self.N
+
+    def summary(self):
+        '''
+            Return the counters and the phase timers as a dict (to be sent to a monitoring system)
+        '''
+        return {
+            "name" : self.name,
+            "steps" : self.t,
+            "particles" : self.N,
+            "seconds" : self.elapsed,
+            "steps_per_second" : self.steps_per_second,
+            "particle_steps_per_second" : self.particle_steps_per_second,
+            "phases" : dict(self.phases),
+        }
+
+
+
+def progress(every = 999):
+    '''
+        Hook printing the progress of the run (the default when verbose is True)
+        Return (hook, every) to be given to a Monitor
+    '''
+    def hook(t, monitor):
+        if monitor.done:
+            print("{} has been computed for {} steps and {} particles.".format(monitor.name, monitor.T, monitor.N))
+        else:
+            print("Computing {}... ({}/{})".format(monitor.name, t, monitor.T), end = "\r")
+    return (hook, every)
+
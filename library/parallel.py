@@ -0,0 +1,73 @@
+#
+# Parallel execution of the TD algorithms
+# The N particles are split across a pool of processes, each one with its own random stream.
+# The workers write their slice of theta directly in memory-mapped files (no pickling of the results).
+#
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from store import RunWriter
+
+
+
+def spawn_seeds(rng, k):
+    '''
+        Return k independent SeedSequence from a seed, a numpy Generator or None
+    '''
+    if isinstance(rng, np.random.Generator):
+        rng = int(rng.integers(2**63)) # Entropy drawn from the generator
+    return np.random.SeedSequence(rng).spawn(k)
+
+
+
+def _worker(args):
+    '''
+        Run the algorithm for one shard of particles, its RunWriter writes it in the shared files
+    '''
+    algo, model, T, seed, writer, stride, trajectories = args
+    algo.run(model, T, writer.stop - writer.start, verbose = False, rng = np.random.default_rng(seed),
+             stride = stride, keep = False, store = writer, trajectories = trajectories)
+    return writer.stop - writer.start
+
+
+
+def parallel_run(algo, model, T, N, workers = None, rng = None, stride = 1, store = None, directory = None, trajectories = None):
+    '''
+        Run algo on the model for N particles split across workers processes (default is the number of cpus)
+        Each worker has an independent random stream spawned from rng (seed or Generator) :
+        the result is reproducible for a given seed and number of workers (but differs from a serial run).
+        Return theta every stride steps (steps, N, p) as a read-only memory-mapped array.
+        The workers write in the files of store (a RunWriter, see store.py) or, by default, in temporary
+        files of directory (default is /dev/shm if it exists, so it stays in RAM).
+        If trajectories are given (see Policy.trajectories) each worker reads the ones of its particles.
+    '''
+    workers = os.cpu_count() if workers is None else int(workers)
+    workers = max(1, min(workers, N))
+
+    temporary = store is None
+    if temporary:
+        if directory is None:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        directory = tempfile.mkdtemp(suffix = ".theta", dir = directory)
+        steps = len(np.unique(np.append(np.arange(0, T+1, max(int(stride), 1)), T)))
+        store = RunWriter(directory, steps, N, model.p, states = False).create()
+
+    try:
+        bounds = np.linspace(0, N, workers + 1).astype(int)
+        seeds = spawn_seeds(rng, workers)
+        shards = [None if trajectories is None else trajectories.particles(bounds[i], bounds[i+1]) for i in range(workers)]
+        tasks = [(algo, model, T, seeds[i], store.shard(bounds[i], bounds[i+1]), stride, shards[i]) for i in range(workers)]
+
+        with multiprocessing.Pool(workers) as pool:
+            pool.map(_worker, tasks)
+
+        return np.load(store.path("theta"), mmap_mode = "r")
+    finally:
+        if temporary:
+            # The mapping stays valid once the files are removed
+            shutil.rmtree(directory)
@@ -0,0 +1,148 @@
+#
+# Plotting of long runs
+# A curve of T steps is drawn with about width points : the steps are split in buckets and each bucket keeps
+# the minimum and the maximum of the curve (the spikes of the emphatic TD stay visible) instead of its T points.
+# The particles can be summarized by quantile bands and a LivePlot draws them while a run is in progress.
+#
+
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from estimators import quantiles
+
+
+
+def buckets(T, width = 2000):
+    '''
+        First step of each bucket : at most width buckets of the same size for T steps (one step by bucket if T <= width)
+    '''
+    size = max(1, -(-T // max(int(width), 1)))
+    return np.arange(0, T, size)
+
+
+def envelope(Y, width = 2000, chunk = None):
+    '''
+        Minimum and maximum of the curves Y (T, ...) over each bucket of steps (first axis) : return (x, low, high)
+        with x the first step of the buckets. Y is read chunk buckets at a time (it can be a memory-mapped array),
+        by default about 1e7 values at a time.
+    '''
+    T = len(Y)
+    x = buckets(T, width)
+    size = x[1] - x[0] if len(x) > 1 else max(T, 1)
+    if chunk is None:
+        chunk = max(1, int(1e7 // (size * max(1, int(np.prod(Y.shape[1:]))))))
+
+    low = np.empty((len(x),) + Y.shape[1:])
+    high = np.empty((len(x),) + Y.shape[1:])
+    for k in range(0, len(x), chunk):
+        starts = x[k:k+chunk]
+        y = np.asarray(Y[starts[0]:min(starts[-1] + size, T)])
+        low[k:k+len(starts)] = np.minimum.reduceat(y, starts - starts[0], axis = 0)
+        high[k:k+len(starts)] = np.maximum.reduceat(y, starts - starts[0], axis = 0)
+    return x, low, high
+
+
+def decimate(Y, width = 2000, chunk = None):
+    '''
+        Min/max decimation of the curves Y (T, ...) : return (x, Y) with two points by bucket (its minimum then its maximum)
+        so a curve has at most 2 width points and keeps its extreme values. Y is returned as it is if T <= width.
+    '''
+    if len(Y) <= width:
+        return np.arange(len(Y)), np.asarray(Y)
+    x, low, high = envelope(Y, width, chunk)
+    res = np.empty((2*len(x),) + low.shape[1:])
+    res[0::2], res[1::2] = low, high
+    return np.repeat(x, 2), res
+
+
+def plot_curves(Y, width = 2000, **kwargs):
+    '''
+        plt.plot of the curves Y (T, ...) decimated (see decimate), kwargs are given to plt.plot
+    '''
+    x, Y = decimate(Y, width)
+    return plt.plot(x, Y, **kwargs)
+
+
+def plot_bands(X, q = (0.1, 0.5, 0.9), width = 2000, color = "black", alpha = 0.3, ax = None):
+    '''
+        Draw the quantiles q across the particles of X (T, N) instead of the N curves :
+        the band between the first and the last quantiles (their envelope on each bucket) and the others as lines.
+    '''
+    ax = plt.gca() if ax is None else ax
+    Q = quantiles(X.T, q) # (len(q), T), the particles are on the first axis
+    x, low, high = envelope(Q.T, width)
+    ax.fill_between(x, low[:, 0], high[:, -1], color = color, alpha = alpha, linewidth = 0)
+    if len(q) > 2:
+        x, Y = decimate(Q[1:-1].T, width)
+        ax.plot(x, Y, c = color, linewidth = 1)
+
+
+
+class LivePlot(object):
+    '''
+        Draw the records of a run while it is in progress, give it as callback of run :
+            live = LivePlot(T, reduce = OnlineMetrics(model).msve)
+            algo.run(model, T, N, callback = live, keep = False)
+        A record goes through reduce (the msve of each particle for example, the record itself by default), it is then
+        summarized by its quantiles q across the particles and only the envelope of the width buckets of the T steps is kept :
+        the memory does not depend on T and N. The figure is redrawn at most every interval seconds (and at the end)
+        so the rendering does not slow the run down. Only the records every k steps (and the last one) are drawn if every is given.
+    '''
+
+    def __init__(self, T, reduce = None, q = (0.1, 0.5, 0.9), width = 2000, every = 1, interval = 1., color = "black", label = None, ax = None):
+        self.T = T
+        self.reduce = reduce
+        self.every = max(int(every), 1)
+        self.q = np.asarray(q)
+        self.interval = interval
+        self.color = color
+        self.label = label
+        self.ax = plt.gca() if ax is None else ax
+
+        self.x = buckets(T + 1, width)
+        self.size = self.x[1] - self.x[0] if len(self.x) > 1 else T + 1
+        self.low = np.full((len(self.x), len(self.q)), np.inf)
+        self.high = np.full((len(self.x), len(self.q)), -np.inf)
+        self.filled = 0 # Number of buckets with a record
+        self._drawn = 0.
+        self._band, self._lines = None, []
+
+    def __call__(self, t, value):
+        if t % self.every != 0 and t < self.T:
+            return
+        value = value if self.reduce is None else self.reduce(value)
+        Q = np.quantile(np.ravel(value), self.q)
+        b = t // self.size
+        self.low[b] = np.minimum(self.low[b], Q)
+        self.high[b] = np.maximum(self.high[b], Q)
+        self.filled = max(self.filled, b + 1)
+        if t >= self.T or time.perf_counter() - self._drawn > self.interval:
+            self.draw()
+
+    def draw(self):
+        '''
+            Update the band and the lines with the buckets recorded so far
+        '''
+        recorded = np.flatnonzero(np.isfinite(self.low[:self.filled, 0])) # A bucket can be shorter than the stride
+        x, low, high = self.x[recorded], self.low[recorded], self.high[recorded]
+        if self._band is not None:
+            self._band.remove()
+        self._band = self.ax.fill_between(x, low[:, 0], high[:, -1], color = self.color, alpha = 0.3, linewidth = 0, label = self.label)
+
+        middle = np.empty((2*len(x), len(self.q) - 2))
+        middle[0::2], middle[1::2] = low[:, 1:-1], high[:, 1:-1]
+        if not self._lines:
+            self._lines = self.ax.plot(np.repeat(x, 2), middle, c = self.color, linewidth = 1)
+        for k, line in enumerate(self._lines):
+            line.set_data(np.repeat(x, 2), middle[:, k])
+
+        # The band is not a line so its limits are added to the ones of the lines
+        self.ax.relim()
+        bounds = np.column_stack((np.append(x, x), np.append(low[:, 0], high[:, -1])))
+        self.ax.update_datalim(bounds[np.all(np.isfinite(bounds), axis = 1)])
+        self.ax.autoscale_view()
+        self.ax.figure.canvas.draw_idle()
+        self.ax.figure.canvas.flush_events()
+        self._drawn = time.perf_counter()
@@ -1,22 +1,155 @@
 import numpy as np
-import itertools
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import warnings
+from utils import diag, fingerprint
+
+
+
+#
+# Stationary distribution solvers
+# Each solver takes P (dense or sparse) and returns d and a dict of diagnostics
+#
+
+def _residual(P, d):
+    ''' L1 norm of d P - d '''
+    return np.abs(P.transpose().dot(d) - d).sum()
+
+def _lazy(P):
+    '''
+        (P + Id) / 2 has the same stationary distribution as P but it is aperiodic
+        and 1 is its only eigenvalue of modulus 1
+    '''
+    n = P.shape[0]
+    Id = sp.identity(n, format = "csr") if sp.issparse(P) else np.eye(n)
+    return (P + Id) / 2
+
+def stationary_direct(P, **options):
+    '''
+        Solve d (P - Id) = 0 with sum(d) = 1 (one redundant equation is replaced by the normalization)
+    '''
+    n = P.shape[0]
+    if sp.issparse(P):
+        # The state 0 first then the one with the largest inflow (usually recurrent)
+        for pivot in (0, int(np.argmax(P.sum(axis = 0)))):
+            d = _sparse_direct(P, pivot)
+            if d is not None:
+                return d, {"iterations" : 1, "pivot" : pivot}
+        Q = (P.transpose() - sp.identity(n)).tolil()
+        Q[0, :] = np.ones(n)
+        solve = lambda Q, e: spla.spsolve(Q.tocsc(), e)
+    else:
+        Q = P.transpose() - np.eye(n)
+        Q[0, :] = 1
+        solve = np.linalg.solve
+    e = np.zeros(n)
+    e[0] = 1
+    d = solve(Q, e)
+    return d, {"iterations" : 1}
+
+def _sparse_direct(P, pivot = 0):
+    '''
+        Solve d (P - Id) = 0 with d[pivot] = 1 and normalize : the row of ones of the normalization
+        makes the sparse LU fill (and slow for large grids) but a unit row keeps it sparse.
+        Return None if the pivot is a transient state (d[pivot] is not free then)
+    '''
+    n = P.shape[0]
+    Q = (P.transpose() - sp.identity(n)).tolil()
+    Q[pivot, :] = 0
+    Q[pivot, pivot] = 1
+    e = np.zeros(n)
+    e[pivot] = 1
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", spla.MatrixRankWarning)
+        d = spla.spsolve(Q.tocsc(), e)
+    if not np.all(np.isfinite(d)) or d.min() < -1e-8 * np.abs(d).max() or _residual(P, d / d.sum()) > 1e-8:
+        return None
+    return d / d.sum()
+
+def stationary_power(P, tol = 1e-10, max_iter = 100000, **options):
+    '''
+        Power iteration d <- d P on the lazy chain (works for periodic chains)
+        Stop when the L1 change is below tol
+    '''
+    n = P.shape[0]
+    P_t = _lazy(P).transpose()
+    d = np.ones(n) / n
+    for it in range(1, max_iter + 1):
+        d_new = P_t.dot(d)
+        change = np.abs(d_new - d).sum()
+        d = d_new
+        if change < tol:
+            return d, {"iterations" : it, "converged" : True}
+    return d, {"iterations" : max_iter, "converged" : False}
+
+def stationary_eigen(P, tol = 1e-10, **options):
+    '''
+        Leading left eigenvector of the lazy chain (sparse Arnoldi if P is sparse)
+    '''
+    n = P.shape[0]
+    if sp.issparse(P) and n > 2:
+        _, vecs = spla.eigs(_lazy(P).transpose(), k = 1, which = "LR", tol = tol)
+        d = vecs[:, 0]
+    else:
+        P = P.toarray() if sp.issparse(P) else P
+        vals, vecs = np.linalg.eig(P.transpose())
+        d = vecs[:, np.argmin(np.abs(vals - 1))]
+    d = np.real(d)
+    return d / d.sum(), {"iterations" : 1}
+
+STATIONARY_SOLVERS = {
+    "direct" : stationary_direct,
+    "power" : stationary_power,
+    "eigen" : stationary_eigen,
+}
+
+
 
 class Policy(object):
     '''
         Store a markov chain policy
         It basically stores the matrix of transition P.
         It adds helpful function to compute the next steps from multiple states (efficient)
+        P can be a scipy.sparse matrix, it is then kept sparse (csr)
+        The stationary distribution is computed by the solver self.stationary (see set_stationary)
     '''
     
+    # Default solver of the stationary distribution (a key of STATIONARY_SOLVERS)
+    stationary = "direct"
+    stationary_options = {}
+    
     def __init__(self, P):
         '''
             Just store P and compute its stationary distrubution
+            (not computed again if P has not changed since the last fit)
         '''
-        self.P = np.array(P)
+        self.P = sp.csr_matrix(P) if sp.issparse(P) else np.array(P)
         
-        self._load_stationary()
+        key = self._matrix_key()
+        if getattr(self, "_key", None) != key:
+            self._load_stationary()
+            self._load_sampler()
+            self._key = key
         
         return self
+    
+    
+    def set_stationary(self, solver = "direct", **options):
+        '''
+            Choose the solver of the stationary distribution : "direct", "power" or "eigen"
+            options are given to the solver (for example tol or max_iter)
+            Return the policy (to chain with the constructor)
+        '''
+        if solver not in STATIONARY_SOLVERS:
+            raise ValueError("Unknown stationary solver {} (available : {})".format(solver, list(STATIONARY_SOLVERS)))
+        self.stationary = solver
+        self.stationary_options = options
+        self._key = None # Force the computation at the next fit
+        return self
+    
+    def _matrix_key(self):
+        ''' A fingerprint of P (and of the solver) to know if the cache is still valid '''
+        return (fingerprint(self.P), self.stationary, tuple(sorted(self.stationary_options.items())))
 
 
     def fit(self, model):
@@ -26,33 +159,89 @@ class Policy(object):
         return self
 
     def _load_stationary(self):
-        ''' Return the stationary distribution of the markov chain P '''
-#        vals, vecs = np.linalg.eigh(self.P.transpose())
-#        I = np.where(np.round(vals, 2) == 1)
-#        i = I[0]
-#        pi_t = vecs[:, i]
-#        pi_t = pi_t/pi_t.sum()
-        a = self.P
-        for _ in range(15):
-            a = np.dot(a, a)
-        pi_t = a[0]
-        self.d = pi_t.flatten()
-        self.D = np.diag(self.d)
-        
-    def next_step(self, s):
+        '''
+            Compute the stationary distribution of the markov chain P
+            The diagnostics of the solver are stored in self.stationary_info
+        '''
+        d, info = STATIONARY_SOLVERS[self.stationary](self.P, **self.stationary_options)
+        d = np.clip(np.real(d), 0, None) # Remove the round-off negative values
+        d = d / d.sum()
+        
+        info["solver"] = self.stationary
+        info["residual"] = float(_residual(self.P, d))
+        info.setdefault("converged", bool(info["residual"] < self.stationary_options.get("tol", 1e-8) * max(1, self.P.shape[0])))
+        if not info["converged"]:
+            warnings.warn("The stationary distribution has not converged (solver {}, residual {:.2e})".format(self.stationary, info["residual"]))
+        
+        self.stationary_info = info
+        self.d = d
+        self.D = diag(self.d, sparse = sp.issparse(self.P))
+        
+    def _load_sampler(self):
+        '''
+            Precompute the cumulative table used to sample the next states.
+            Only the non zero transitions are kept (row by row) and the cumulative
+            distribution of the row s is shifted by s. Thus all the rows are stored
+            in one increasing array and a single searchsorted draws every particle.
+        '''
+        if sp.issparse(self.P):
+            P = self.P.tocoo()
+            keep = P.data != 0
+            order = np.lexsort((P.col[keep], P.row[keep])) # Row major order
+            rows, cols, probs = P.row[keep][order], P.col[keep][order], P.data[keep][order]
+        else:
+            rows, cols = np.nonzero(self.P)
+            probs = self.P[rows, cols]
+        
+        # Cumulative distribution inside each row
+        cum = np.cumsum(probs)
+        n = self.P.shape[0]
+        starts = np.searchsorted(rows, np.arange(n)) # First non zero of each row
+        row_offset = np.concatenate(([0.], cum))[starts] # Mass of the previous rows
+        totals = np.bincount(rows, weights = probs, minlength = n)
+        cum = (cum - row_offset[rows]) / totals[rows]
+        
+        # The last transition of a row must end exactly at 1 (round-off)
+        last = np.append(rows[1:] != rows[:-1], True)
+        cum[last] = 1.
+        
+        self._sampler_keys = rows + cum
+        self._sampler_states = cols
+        
+    def next_step(self, s, rng = None):
         '''  Pick a state according to the mass distribution of s '''
-        P = self.P[s]
-        m = len(P)
-        return int(np.random.choice(np.arange(m), 1, p = list(P)))
-    
-    def parallel_steps(self, S):
-        ''' Pick the next step for all the states in S (in parallel) '''
-        S_new = S.copy()
-        for s in np.unique(S):
-            idxs = np.where(S == s)
-            n = len(idxs[0]) # Number of chain in state s
-            S_new[idxs] = np.random.choice(len(self.P), n, p = self.P[s])
-        return S_new
+        return int(self.parallel_steps(np.array([s]), rng = rng)[0])
+    
+    def parallel_steps(self, S, rng = None):
+        '''
+            Pick the next step for all the states in S (in parallel)
+            rng can be a numpy Generator (default is the global numpy random state)
+        '''
+        S = np.asarray(S)
+        rng = np.random if rng is None else rng
+        U = S + rng.random(S.shape) # Uniform draw shifted in the row of each state
+        idxs = np.searchsorted(self._sampler_keys, U, side = "right")
+        return self._sampler_states[idxs].astype(S.dtype, copy = False)
+    
+    def trajectories(self, S, T, rng = None, block = 2**20, dtype = None):
+        '''
+            Sample the next T states of the particles in S, return a Trajectories with the states (T+1, N) (S first).
+            The uniforms are drawn by blocks of at most block values and a step is a single searchsorted :
+            the states are the ones of T calls of parallel_steps with the same rng.
+            dtype is the one of the states stored (the one of S by default, see utils.int_dtype to save memory).
+            The trajectories can be given to the runs of several algorithms (common random numbers, see AbstractTD.run)
+        '''
+        S = np.asarray(S)
+        rng = np.random if rng is None else rng
+        states = np.empty((T+1, len(S)), dtype = S.dtype if dtype is None else dtype)
+        states[0] = S
+        steps = max(1, block // max(len(S), 1))
+        for start in range(0, T, steps):
+            U = rng.random((min(steps, T - start), len(S)))
+            for k in range(len(U)):
+                S = self._sampler_states[np.searchsorted(self._sampler_keys, S + U[k], side = "right")]
+                states[start + k + 1] = S
+        return Trajectories(states, self._key[0])
     
     def __str__(self):
         if hasattr(self, 'P'): # the policy is defined
@@ -65,6 +254,68 @@ class Policy(object):
     
     
     
+class Trajectories(object):
+    '''
+        States of N particles during T steps sampled from a policy (see Policy.trajectories)
+        states is (T+1, N) and policy the fingerprint of the transition matrix they are sampled from
+    '''
+    
+    def __init__(self, states, policy):
+        self.states = states
+        self.policy = policy
+    
+    @property
+    def T(self):
+        return self.states.shape[0] - 1
+    
+    @property
+    def N(self):
+        return self.states.shape[1]
+    
+    def particles(self, start, stop):
+        ''' The trajectories of the particles start to stop (a view) '''
+        return Trajectories(self.states[:, start:stop], self.policy)
+    
+    def save(self, path):
+        ''' Write the trajectories in the file path (.npz) '''
+        np.savez(path, states = self.states, policy = np.array(self.policy))
+    
+    @staticmethod
+    def load(path):
+        ''' Read trajectories written by save '''
+        with np.load(path if path.endswith(".npz") else path + ".npz") as f:
+            return Trajectories(f["states"], str(f["policy"]))
+    
+    
+    
+class BatchPolicy(Policy):
+    '''
+        The policies of the B models of a ModelBatch as one policy on the B*n states of the batch
+        (P is block diagonal). The stationary distribution and the sampler are the ones of the
+        fitted policies, so the batch particles are sampled as in their own model.
+    '''
+    def __init__(self, policies):
+        self.policies = list(policies)
+
+    def fit(self, model):
+        P = sp.block_diag([sp.csr_matrix(policy.P) for policy in self.policies], format = "csr")
+        return super(BatchPolicy, self).__init__(P)
+
+    def _load_stationary(self):
+        # P is reducible : the stationary distribution of the batch is the mean of the ones of the models
+        self.d = np.concatenate([policy.d for policy in self.policies]) / len(self.policies)
+        self.D = diag(self.d, sparse = True)
+        self.stationary_info = {"solver" : "batch", "iterations" : 0, "residual" : float(_residual(self.P, self.d)),
+                                "converged" : all(policy.stationary_info["converged"] for policy in self.policies)}
+
+    def _load_sampler(self):
+        # The cumulative table of each policy shifted by the offset of its model
+        offsets = np.cumsum([0] + [policy.P.shape[0] for policy in self.policies])
+        self._sampler_keys = np.concatenate([p._sampler_keys + o for p, o in zip(self.policies, offsets)])
+        self._sampler_states = np.concatenate([p._sampler_states + o for p, o in zip(self.policies, offsets)])
+
+
+
 class LeftRightPolicy(Policy):
     def __init__(self, p_right = None, p_left = None):
         '''Compute the P matrix associate to the right and left policy'''
@@ -120,31 +371,29 @@ class GridRandomWalkPolicy(Policy):
     
     
     def fit(self, model):
+        '''
+            P is built as a stencil : the next state of each move is computed for all the states at once
+            with the index arithmetic of the grid (id = x * l_y + y)
+        '''
         l_x, l_y, n = model.l_x, model.l_y, model.n
-        P = np.zeros((n, n))
-        for x, y in itertools.product(range(l_x), range(l_y)):
-            idx = model.coords_to_id((x, y))
-            
-            # Up
-            id_next = model.coords_to_id((x - 1, y))
-            if id_next is False: id_next = idx # If not exists it does not move
-            P[idx, id_next] += self.p_up
-            
-            # Down
-            id_next = model.coords_to_id((x + 1, y))
-            if id_next is False: id_next = idx # If not exists it does not move
-            P[idx, id_next] += self.p_down
-            
-            # Right
-            id_next = model.coords_to_id((x, y + 1))
-            if id_next is False: id_next = idx # If not exists it does not move
-            P[idx, id_next] += self.p_right
-            
-            # Left
-            id_next = model.coords_to_id((x, y - 1))
-            if id_next is False: id_next = idx # If not exists it does not move
-            P[idx, id_next] += self.p_left
+        ids = np.arange(n)
+        x, y = np.divmod(ids, l_y)
+        
+        rows, cols, probs = [], [], []
+        for p, dx, dy in [(self.p_up, -1, 0), (self.p_down, 1, 0), (self.p_right, 0, 1), (self.p_left, 0, -1)]:
+            x_next, y_next = x + dx, y + dy
+            inside = (0 <= x_next) & (x_next < l_x) & (0 <= y_next) & (y_next < l_y)
+            rows.append(ids)
+            cols.append(np.where(inside, x_next * l_y + y_next, ids)) # If not exists it does not move
+            probs.append(np.full(n, p, dtype = float))
+        P = sp.coo_matrix((np.concatenate(probs), (np.concatenate(rows), np.concatenate(cols))), shape = (n, n))
             
-        P = (P.T / np.sum(P, axis = 1)).T
+        if model.sparse:
+            P = P.tocsr()
+            P.eliminate_zeros()
+            P = sp.diags(1 / np.asarray(P.sum(axis = 1)).ravel()) @ P
+        else:
+            P = P.toarray()
+            P = (P.T / np.sum(P, axis = 1)).T
             
-        return super(GridRandomWalkPolicy, self).__init__(P)  
\ No newline at end of file
+        return super(GridRandomWalkPolicy, self).__init__(P)
@@ -0,0 +1,101 @@
+#
+# Linear solvers
+# The matrices are factorized once (LU or Cholesky) and the factorizations are cached,
+# thus the same system can be solved for many right hand sides (many lambdas, many alphas, ...)
+#
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import scipy.linalg as la
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+
+
+class Factorization(object):
+    '''
+        Factorization of a square matrix A (dense or sparse) to solve A x = B or A^T x = B.
+        method is "lu" or "cholesky" (A must be symmetric positive definite).
+        Scipy has no sparse Cholesky, a sparse A always uses the sparse LU (splu).
+    '''
+
+    def __init__(self, A, method = "lu"):
+        self.sparse = sp.issparse(A)
+        self.method = "lu" if self.sparse else method
+
+        if self.sparse:
+            self.A = sp.csc_matrix(A)
+            self.factor = spla.splu(self.A)
+        elif self.method == "cholesky":
+            self.factor = la.cho_factor(A)
+        elif self.method == "lu":
+            self.factor = la.lu_factor(A)
+        else:
+            raise ValueError("Unknown factorization method {} (lu or cholesky)".format(method))
+
+    def solve(self, B, transpose = False):
+        '''
+            Return the solution of A x = B (A^T x = B if transpose)
+            B can be a vector or a matrix (a sparse B gives a sparse solution)
+        '''
+        if self.sparse:
+            if sp.issparse(B):
+                # splu only accepts dense right hand sides, spsolve keeps the solution sparse
+                A = self.A.transpose() if transpose else self.A
+                return spla.spsolve(sp.csc_matrix(A), sp.csc_matrix(B))
+            return self.factor.solve(np.asarray(B, dtype = float), trans = "T" if transpose else "N")
+
+        B = B.toarray() if sp.issparse(B) else B
+        if self.method == "cholesky":
+            return la.cho_solve(self.factor, B) # A is symmetric
+        return la.lu_solve(self.factor, B, trans = 1 if transpose else 0)
+
+
+
+#
+# Cache of the factorizations (the key is a fingerprint of the matrix)
+#
+
+_cache = OrderedDict()
+CACHE_SIZE = 32
+
+def _fingerprint(A):
+    ''' Hash of the content of A (much cheaper than its factorization) '''
+    h = hashlib.sha1()
+    if sp.issparse(A):
+        A = sp.csc_matrix(A)
+        A.sort_indices()
+        arrays = (A.indptr, A.indices, A.data)
+    else:
+        arrays = (A,)
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).tobytes())
+    return (A.shape, str(A.dtype), sp.issparse(A), h.hexdigest())
+
+def factorize(A, method = "lu"):
+    '''
+        Return the (cached) Factorization of A
+    '''
+    key = _fingerprint(A) + (method,)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    factor = Factorization(A, method = method)
+    _cache[key] = factor
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last = False) # Remove the least recently used
+    return factor
+
+def solve(A, B, transpose = False, method = "lu"):
+    '''
+        Solve A x = B (A^T x = B if transpose) for a dense or a sparse A
+        The factorization of A is reused by the next calls with the same A
+    '''
+    return factorize(A, method = method).solve(B, transpose = transpose)
+
+def clear_cache():
+    ''' Forget all the factorizations '''
+    _cache.clear()
@@ -0,0 +1,138 @@
+#
+# On-disk store of the results
+# Each run is a directory with memory-mapped .npy files (theta, S, ...) and its metadata (meta.json).
+# The arrays are read back lazily (np.load with mmap_mode) so multi-GB runs do not need to fit in memory.
+#
+
+import os
+import json
+import copy
+
+import numpy as np
+
+
+
+class RunWriter(object):
+    '''
+        Write the records of one run (theta (steps, N, p) and the states S (steps, N)) in .npy files.
+        It is given to the run of the algorithms (store argument).
+        The files are opened lazily, so a writer (or a shard of it) can be sent to other processes.
+    '''
+
+    def __init__(self, directory, steps, N, p, states = True):
+        self.directory = directory
+        self.shape = (steps, N, p)
+        self.states = states
+        self.start, self.stop = 0, N # Particles written by this writer
+        self._files = None
+
+    def create(self):
+        '''
+            Allocate the files on disk
+        '''
+        steps, N, p = self.shape
+        np.lib.format.open_memmap(self.path("theta"), mode = "w+", dtype = float, shape = self.shape).flush()
+        if self.states:
+            np.lib.format.open_memmap(self.path("S"), mode = "w+", dtype = np.int64, shape = (steps, N)).flush()
+        return self
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def shard(self, start, stop):
+        '''
+            Return a writer of the particles start to stop (their index in the run is then 0 to stop - start)
+        '''
+        shard = copy.copy(self)
+        shard.start, shard.stop = start, stop
+        shard._files = None
+        return shard
+
+    def write(self, i, theta, S = None):
+        '''
+            Write the i-th record
+        '''
+        if self._files is None:
+            self._files = {"theta" : np.lib.format.open_memmap(self.path("theta"), mode = "r+")}
+            if self.states:
+                self._files["S"] = np.lib.format.open_memmap(self.path("S"), mode = "r+")
+        self._files["theta"][i, self.start:self.stop] = theta
+        if self.states and S is not None:
+            self._files["S"][i, self.start:self.stop] = S
+
+    def close(self):
+        '''
+            Flush the files (called at the end of the run)
+        '''
+        if self._files is not None:
+            for f in self._files.values():
+                f.flush()
+        self._files = None
+
+    def __getstate__(self):
+        # The memory maps are opened again by the other processes
+        state = self.__dict__.copy()
+        state["_files"] = None
+        return state
+
+
+
+class ResultStore(object):
+    '''
+        A directory storing the runs by name : theta and S (memory-mapped), other arrays
+        (deterministic descent, MOM, ...) and the metadata (model hash, alpha, lambdas, seed, ...).
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    def _dir(self, name):
+        return os.path.join(self.path, str(name))
+
+    def names(self):
+        ''' The names of the stored runs '''
+        return sorted(d for d in os.listdir(self.path) if os.path.isfile(os.path.join(self._dir(d), "meta.json")))
+
+    def __contains__(self, name):
+        return os.path.isfile(os.path.join(self._dir(name), "meta.json"))
+
+    def writer(self, name, model, algo, T, N, stride = 1, seed = None, states = True, **meta):
+        '''
+            Create the run name for the algorithm on the model and return its RunWriter
+            The records are the ones of run (every stride steps and the last one)
+        '''
+        directory = self._dir(name)
+        os.makedirs(directory, exist_ok = True)
+        steps = len(np.unique(np.append(np.arange(0, T+1, max(int(stride), 1)), T)))
+
+        meta.update({
+            "algo" : type(algo).__name__,
+            "alpha" : float(algo.alpha),
+            "lambdas" : np.asarray(algo.lambdas, dtype = float).tolist(),
+            "model" : model.fingerprint(),
+            "T" : int(T),
+            "N" : int(N),
+            "p" : int(model.p),
+            "stride" : int(stride),
+            "seed" : seed if (seed is None or isinstance(seed, int)) else None, # A Generator cannot be stored
+        })
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent = 1)
+
+        return RunWriter(directory, steps, N, model.p, states = states).create()
+
+    def save(self, name, key, array):
+        ''' Store another array for the run name (for example the deterministic descent) '''
+        np.save(os.path.join(self._dir(name), key + ".npy"), np.asarray(array))
+
+    def load(self, name, key = "theta", mmap_mode = "r"):
+        '''
+            Return the array key of the run name, memory-mapped (no copy) by default
+        '''
+        return np.load(os.path.join(self._dir(name), key + ".npy"), mmap_mode = mmap_mode)
+
+    def meta(self, name):
+        ''' Return the metadata of the run name '''
+        with open(os.path.join(self._dir(name), "meta.json")) as f:
+            return json.load(f)
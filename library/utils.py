@@ -2,10 +2,17 @@
 # Utilities functions
 #
 
+import hashlib
+
 import numpy as np
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 
+from parallel import parallel_run
+from estimators import mom # Median of means (kept here for the old imports)
+from plotting import plot_curves, plot_bands, LivePlot
+
 
 
 def custom_mult(X, m):
@@ -13,15 +20,251 @@ def custom_mult(X, m):
         Custom multiplication for the features of the N particles
         Surely there is another way.
     '''
-    return (X.T * m).T
+    if sp.issparse(X):
+        return sp.diags(m) @ X
+    return (X.T * np.transpose(_like(m, X))).T # m can have the leading axes of X (configurations, particles)
+
+
+
+#
+# Dense / sparse helpers
+# Matrices of the model (features, P, R, phi) can be numpy arrays or scipy.sparse matrices
+#
+
+def identity(n, sparse = False):
+    ''' Identity matrix (sparse csr or dense) '''
+    return sp.identity(n, format = "csr") if sparse else np.eye(n)
+
+def diag(v, sparse = False):
+    ''' Diagonal matrix from a vector (sparse csr or dense) '''
+    return sp.diags(np.asarray(v, dtype = float), format = "csr") if sparse else np.diag(v)
+
+def multiply(X, Y):
+    ''' Element-wise product of two matrices (sparse if one of them is sparse) '''
+    if sp.issparse(X):
+        return X.multiply(Y).tocsr()
+    if sp.issparse(Y):
+        return Y.multiply(X).tocsr()
+    return X * Y
+
+def row_sums(X):
+    ''' Sum over the columns as a flat array '''
+    return np.asarray(X.sum(axis = 1)).ravel()
+
+def gather(X, rows, cols):
+    ''' Return the flat array X[rows[k], cols[k]] '''
+    if sp.issparse(X):
+        return np.asarray(X[rows, cols]).ravel()
+    return X[rows, cols]
+
+def row_dot(X, theta):
+    '''
+        Dot product of each row of X (N, p) with the row of theta of the same particle.
+        theta can have leading axes (..., N, p), the result is (..., N).
+        Equivalent to np.sum(X * theta, axis = -1)
+    '''
+    if sp.issparse(X):
+        X = X.tocoo()
+        if X.nnz == 0:
+            return np.zeros(theta.shape[:-1], dtype = theta.dtype)
+        contrib = theta[..., X.row, X.col] * X.data # (..., nnz)
+        rows = sp.csr_matrix((np.ones(X.nnz), (X.row, np.arange(X.nnz))), shape = (X.shape[0], X.nnz))
+        res = rows.dot(contrib.reshape((-1, X.nnz)).transpose()).transpose() # Sum the entries of each row
+        return res.reshape(theta.shape[:-1])
+    return np.sum(theta * X, axis = -1)
+
+def add_rows(theta, X, m):
+    '''
+        Return theta + custom_mult(X, m) as a dense array.
+        theta can have leading axes (..., N, p) with m (..., N)
+        For a sparse X only the non zero entries are added.
+    '''
+    if sp.issparse(X):
+        X = X.tocoo()
+        X.sum_duplicates() # Each entry once so the in-place addition is safe
+        res = theta.copy()
+        res[..., X.row, X.col] += X.data * m[..., X.row]
+        return res
+    return theta + X * _like(m, theta)[..., None]
+
+def fingerprint(*arrays):
+    '''
+        Hash of the content of dense or sparse arrays (None is allowed).
+        Used to know if something computed from them is still valid.
+    '''
+    h = hashlib.sha1()
+    for X in arrays:
+        if X is None:
+            h.update(b"None")
+            continue
+        if sp.issparse(X):
+            X = sp.csr_matrix(X)
+            X.sort_indices()
+            parts = (X.indptr, X.indices, X.data)
+        else:
+            X = np.asarray(X)
+            parts = (X,)
+        h.update("{}{}{}".format(type(X).__name__, X.shape, X.dtype).encode())
+        for a in parts:
+            h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+
+def _like(m, X):
+    '''
+        m with the float dtype of X (so a float32 X is not promoted to float64 by the product)
+    '''
+    m = np.asarray(m)
+    if np.issubdtype(X.dtype, np.floating) and X.dtype != m.dtype:
+        return m.astype(X.dtype)
+    return m
+
+
+
+class Precision(object):
+    '''
+        dtypes of a run :
+            theta : theta and the traces (E, e, w)
+            features : the features of the particles (theta by default)
+            accumulate : the traces accumulated across the steps that can blow up (follow-on F of the emphatic TD)
+            states : the states S, "auto" is the smallest of int16, int32 and int64 for the number of states
+        The scalars of a step (delta, rho, ...) stay in float64.
+    '''
+    
+    def __init__(self, theta = np.float64, features = None, accumulate = np.float64, states = np.int64):
+        self.theta = np.dtype(theta)
+        self.features = self.theta if features is None else np.dtype(features)
+        self.accumulate = np.dtype(accumulate)
+        self.states = states
+    
+    def states_dtype(self, n):
+        ''' dtype of the states of a model with n states '''
+        if self.states != "auto":
+            return np.dtype(self.states)
+        return int_dtype(n)
+    
+    def __repr__(self):
+        return "Precision(theta = {}, features = {}, accumulate = {}, states = {})".format(self.theta, self.features, self.accumulate, self.states)
+
+def int_dtype(n):
+    ''' The smallest of int16, int32 and int64 for the states of a model with n states '''
+    for dtype in (np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+PRECISIONS = {
+    "double" : Precision(),
+    "single" : Precision(np.float32, states = "auto"), # F is still accumulated in float64
+}
+
+def get_precision(precision = None):
+    '''
+        Return a Precision from its name ("double" or "single"), a Precision or None (double)
+    '''
+    if precision is None:
+        return PRECISIONS["double"]
+    if isinstance(precision, Precision):
+        return precision
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {} (available : {})".format(precision, list(PRECISIONS)))
+    return PRECISIONS[precision]
+
+
+
+def get_rng(rng = None):
+    '''
+        Return a numpy Generator from a seed, a Generator or None.
+        None keeps the global numpy random state (np.random.seed still works).
+    '''
+    if rng is None or isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng)
 
 
 
+class Recorder(object):
+    '''
+        Record theta during a run without keeping the whole trajectory.
+        Every stride steps (and at the last step) theta goes through record
+        and the result is stored and/or passed to callback(t, value).
+        record can be None (a copy of theta (N, p)), "mean" or "median" (across the particles),
+        "msve" (msve of each particle) or any function of theta.
+        If keep is False nothing is stored and only the callback is used (O(N*p) memory).
+        store is a RunWriter (see store.py) receiving the records and the states S on disk.
+    '''
+    
+    def __init__(self, model, T, stride = 1, record = None, callback = None, keep = True, store = None):
+        self.T = T
+        self.stride = max(int(stride), 1)
+        self.callback = callback
+        self.keep = keep
+        self.store = store
+        
+        if record is None:
+            self.record = lambda theta: theta
+        elif record == "mean":
+            self.record = lambda theta: np.mean(theta, axis = 0)
+        elif record == "median":
+            self.record = lambda theta: np.median(theta, axis = 0)
+        elif record == "msve":
+            self.record = model.msve
+        else:
+            self.record = record
+        
+        self.times = np.unique(np.append(np.arange(0, T+1, self.stride), T)) # Recorded steps
+        self.values = None
+        self._i = 0
+        
+    def __call__(self, t, theta, S = None):
+        if (t % self.stride != 0) and (t != self.T):
+            return
+        value = np.asarray(self.record(theta))
+        if self.callback is not None:
+            self.callback(t, value)
+        if self.store is not None:
+            self.store.write(self._i, value, S)
+        if self.keep:
+            if self.values is None: # Allocate once the shape of a record is known
+                self.values = np.zeros((len(self.times),) + value.shape, dtype = value.dtype)
+            self.values[self._i] = value
+        self._i += 1
+        if self.store is not None and t == self.T:
+            self.store.close()
+    
+    def result(self):
+        '''
+            Return the records stacked on the first axis (None if nothing is kept)
+        '''
+        return self.values
+    
+    def state(self):
+        '''
+            Return the arrays needed to restore the recorder (see Checkpoint) : the number of records and the kept records
+        '''
+        state = {"i" : np.array(self._i)}
+        if self.values is not None:
+            state["values"] = self.values[:self._i]
+        return state
+    
+    def restore(self, state):
+        ''' Restore the recorder from state (see state) '''
+        self._i = int(state["i"])
+        if self.keep and "values" in state:
+            values = state["values"]
+            self.values = np.zeros((len(self.times),) + values.shape[1:], dtype = values.dtype)
+            self.values[:self._i] = values
+        
+
+
 def to_array_of_vectors(X):
     '''
         Assure that the numpy array of features has the good shape.
         Convert (x,) shape to (x,1) if necessary
     '''
+    if sp.issparse(X):
+        return sp.csr_matrix(X)
     X = np.array(X)
     shape = X.shape
     if len(shape) == 1:
@@ -29,20 +272,6 @@ def to_array_of_vectors(X):
     else:
         return X
     
-def mom(X, K = 10):
-    '''
-     Compute the mediam of means with K classes
-    '''
-    C = np.random.randint(0, K, len(X))
-    means = []
-    for k in range(K):
-        m = np.mean(X[np.where(C == k)], axis = 0)
-        means.append(m)
-    return np.median(means, axis = 0)
-
-
-
-
 class comparatorTD(object):
     '''
         This class below is used to make the notebook clearer.
@@ -58,33 +287,86 @@ class comparatorTD(object):
         self.names = ["Algo {}".format(i+1) for i in range(len(algos))] if names is None else names
         
         self.res = None
+        self._msve = {} # msve of the results of each algorithm (computed at the first plot)
         
         
         
         
-    def run(self, model, T, N, verbose = True):   
+    def run(self, model, T, N, verbose = True, rng = None, workers = None, store = None, crn = False, live = False):   
         '''
             Run the offTD and the empTD on the model
             Compute also the deterministic descent
                          the MOM estimator (to remove outlier)
                          the theta optimal
+            rng is a seed or a numpy Generator to reproduce the runs
+            If workers is given the particles are split across this number of processes (see parallel_run)
+            If store is a ResultStore the results are written on disk (with the names of the algorithms)
+            and self.res holds memory-mapped arrays, see load to read them back later
+            If crn is True the trajectories of the particles are sampled once and all the algorithms learn from
+            the same transitions (common random numbers), they are kept in self.trajectories ((T+1) * N states)
+            If live is True the quantiles of the msve of the particles are drawn while the algorithms run (see LivePlot,
+            not with workers)
         '''
         self.model = model
+        self._msve = {}
+        seed = rng
+        rng = get_rng(rng)
+        
+        if live:
+            from metrics import OnlineMetrics # metrics imports utils
+            msve = OnlineMetrics(model).msve
+            plt.figure()
+            plt.title("MSVE with {} particles".format(N))
+            plt.ylabel("MSVE")
+            plt.xlabel("steps")
+        
+        self.trajectories = None
+        if crn:
+            S, _ = model.start(N)
+            self.trajectories = model.mu.trajectories(S, T, rng = rng, dtype = int_dtype(model.n))
         
         self.res = []
-        for algo in self.algos:
-            theta = algo.run(model, T, N, verbose = verbose)   
+        for algo, name, color in zip(self.algos, self.names, self.colors):
+            writer = None if store is None else store.writer(name, model, algo, T, N, seed = seed, states = workers is None)
+            if workers is None:
+                callback = LivePlot(T, reduce = msve, every = max(1, T // 2000), color = color, label = name) if live else None
+                theta = algo.run(model, T, N, verbose = verbose, rng = rng, keep = writer is None, store = writer, trajectories = self.trajectories, callback = callback)
+                theta = theta if writer is None else store.load(name)
+            else:
+                theta = parallel_run(algo, model, T, N, workers = workers, rng = rng, store = writer, trajectories = self.trajectories)
+                if verbose:
+                    print("{} has been computed for {} steps and {} particles on {} processes.".format(type(algo).__name__, T, N, workers))
             theta_opt = algo.optimal_run(model, T)
-            theta_mom = mom(np.swapaxes(theta, 0, 1))
+            theta_mom = mom(np.swapaxes(theta, 0, 1), rng = rng)
             #theta_final = algo.optimal(self.model)  
             
+            if store is not None:
+                store.save(name, "theta_opt", theta_opt)
+                store.save(name, "theta_mom", theta_mom)
             self.res.append((theta, theta_opt, theta_mom))
         
+        if live:
+            plt.legend()
         
         
-    def plot_theta(self, i = 0, mom = True, particles = True, optimal = True, figure = True, ylim = None):
+    def load(self, model, store):
+        '''
+            Read back lazily the results of the algorithms (by name) from a ResultStore
+        '''
+        self.model = model
+        self._msve = {}
+        self.res = []
+        for name in self.names:
+            if store.meta(name)["model"] != model.fingerprint():
+                raise ValueError("The run {} has been computed for another model !".format(name))
+            self.res.append((store.load(name), store.load(name, "theta_opt"), store.load(name, "theta_mom")))
+        
+        
+    def plot_theta(self, i = 0, mom = True, particles = True, optimal = True, figure = True, ylim = None, bands = None, width = 2000):
         '''
             Plot one dimension (i) of theta across the particles
+            The curves are decimated to width buckets (their minimum and maximum, see plotting.decimate).
+            If bands are quantiles (for example (0.1, 0.5, 0.9)) they are drawn instead of the particles.
         '''
         
         if figure: plt.figure()
@@ -97,15 +379,17 @@ class comparatorTD(object):
             T, N, p = theta.shape
             
             legends.append(mlines.Line2D([], [], color=color, label=name))
-            if particles:
-                plt.plot(theta[:, : , i].squeeze(), linewidth = 0.2, c = color)
+            if bands is not None:
+                plot_bands(theta[:, :, i], bands, width, color = color)
+            elif particles:
+                plot_curves(theta[:, :, i], width, linewidth = 0.2, c = color)
         
-            color_others = "black" if particles else color
+            color_others = "black" if particles or bands is not None else color
             if optimal:
-                plt.plot(theta_opt[:, i], c = color_others, linewidth = 3)
+                plot_curves(theta_opt[:, i], width, c = color_others, linewidth = 3)
             
             if mom:
-                plt.plot(theta_mom[:, i], linewidth = 3, c = color_others, linestyle = "dotted")
+                plot_curves(theta_mom[:, i], width, linewidth = 3, c = color_others, linestyle = "dotted")
             
             if ylim is None:
                 # Auto set up of limit
@@ -138,9 +422,21 @@ class comparatorTD(object):
         
         
         
-    def plot_msve(self, figure = True, ylim = None, particles = True, optimal = True, mom = True):
+    def msve(self, k):
+        '''
+            Return the msve of the particles (T, N), of the deterministic descent and of the MOM for the algorithm k
+            They are computed once and kept until the next run or load
+        '''
+        if k not in self._msve:
+            theta, theta_opt, theta_mom = self.res[k]
+            self._msve[k] = (self.model.parallel_msve(theta), self.model.msve(theta_opt), self.model.msve(theta_mom))
+        return self._msve[k]
+        
+        
+    def plot_msve(self, figure = True, ylim = None, particles = True, optimal = True, mom = True, bands = None, width = 2000):
         '''
             Plot the msve of theta across the particles
+            The msve is computed at the first call only (see msve), width and bands are the ones of plot_theta
         '''        
         if figure: plt.figure()
         
@@ -148,26 +444,23 @@ class comparatorTD(object):
         
         ymin, ymax = None, None
         
-        for res, algo, color, name in zip(self.res, self.algos, self.colors, self.names):
-            theta, theta_opt, theta_mom = res
-            T, N, p = theta.shape
-            
-            # Compute msve
-            msve = self.model.parallel_msve(theta)
-            msve_opt = self.model.msve(theta_opt)
-            msve_mom = self.model.msve(theta_mom)
+        for k, (algo, color, name) in enumerate(zip(self.algos, self.colors, self.names)):
+            msve, msve_opt, msve_mom = self.msve(k)
+            T, N = msve.shape
             
             legends.append(mlines.Line2D([], [], color=color, label=name))
             
-            if particles:
-                plt.plot(msve, linewidth = 0.2, c = color)
+            if bands is not None:
+                plot_bands(msve, bands, width, color = color)
+            elif particles:
+                plot_curves(msve, width, linewidth = 0.2, c = color)
         
-            color_others = "black" if particles else color
+            color_others = "black" if particles or bands is not None else color
             if optimal:
-                plt.plot(msve_opt, c = color_others, linewidth = 3)
+                plot_curves(msve_opt, width, c = color_others, linewidth = 3)
             
             if mom:
-                plt.plot(msve_mom, linewidth = 3, c = color_others, linestyle = "dotted")
+                plot_curves(msve_mom, width, linewidth = 3, c = color_others, linestyle = "dotted")
             
             # Auto set up of limit
             if ylim is None: